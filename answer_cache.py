@@ -0,0 +1,131 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from metrics import metrics
+
+
+def normalize_question(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().rstrip("?!. ").lower()
+
+
+class CachedAnswer:
+    def __init__(self, question: str, vector: np.ndarray, answer: str, latency: float) -> None:
+        self.question = question
+        self.vector = vector
+        self.answer = answer
+        self.latency = latency
+        self.created_at = time.monotonic()
+
+
+class AnswerCacheStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def describe(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate), "
+            f"{self.saved_seconds:.1f}s saved, {self.evictions} evicted, "
+            f"{self.invalidations} invalidated"
+        )
+
+
+class AnswerCache:
+    def __init__(self, threshold: float = 0.95, ttl: float = 24 * 60 * 60, max_entries: int = 2000) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Least recently used first, keyed by (namespace, normalized question).
+        self.entries: OrderedDict[Tuple[str, str], CachedAnswer] = OrderedDict()
+        # Stacked question vectors per namespace, rebuilt after a change.
+        self.matrices: Dict[str, Tuple[list, np.ndarray]] = {}
+        self.stats = AnswerCacheStats()
+        self.lock = threading.Lock()
+
+    def embed(self, question: str, embeddings: Embeddings) -> np.ndarray:
+        vector = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def matrix(self, namespace: str) -> Tuple[list, np.ndarray]:
+        if namespace not in self.matrices:
+            keys = [key for key in self.entries if key[0] == namespace]
+            vectors = [self.entries[key].vector for key in keys]
+            self.matrices[namespace] = (keys, np.stack(vectors) if vectors else None)
+        return self.matrices[namespace]
+
+    def remove(self, key: Tuple[str, str]) -> None:
+        del self.entries[key]
+        self.matrices.pop(key[0], None)
+
+    def find(self, namespace: str, question: str, vector: np.ndarray | None) -> CachedAnswer | None:
+        entry = self.entries.get((namespace, question))
+        if entry is None and vector is not None:
+            keys, matrix = self.matrix(namespace)
+            if matrix is not None:
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self.entries[keys[best]]
+        if entry is None:
+            return None
+        key = (namespace, entry.question)
+        if time.monotonic() - entry.created_at > self.ttl:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get(self, namespace: str, question: str, embeddings: Embeddings) -> Tuple[str | None, tuple]:
+        # Returns the cached answer, or None and a key for put() so a miss
+        # does not embed the question twice. An exact repeat skips embedding.
+        start = time.perf_counter()
+        question = normalize_question(question)
+        with self.lock:
+            entry = self.find(namespace, question, None)
+        vector = None
+        if entry is None:
+            vector = self.embed(question, embeddings)
+            with self.lock:
+                entry = self.find(namespace, question, vector)
+        with self.lock:
+            metrics.cache("answer", hits=entry is not None, misses=entry is None)
+            if entry is None:
+                self.stats.misses += 1
+                return None, (question, vector)
+            self.stats.hits += 1
+            self.stats.saved_seconds += max(0.0, entry.latency - (time.perf_counter() - start))
+            return entry.answer, (question, vector)
+
+    def put(self, namespace: str, key: tuple, answer: str, latency: float) -> None:
+        question, vector = key
+        if vector is None or not answer:
+            return
+        with self.lock:
+            self.entries[(namespace, question)] = CachedAnswer(question, vector, answer, latency)
+            self.entries.move_to_end((namespace, question))
+            self.matrices.pop(namespace, None)
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.stats.evictions += 1
+
+    def invalidate(self, namespace: str) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == namespace]:
+                self.remove(key)
+                self.stats.invalidations += 1
+            self.matrices.pop(namespace, None)
@@ -1,31 +1,134 @@
 from datetime import datetime
-from typing import Dict, Set, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Set, Tuple
 from utils import validate_json
-from lxml import html
+from downloader import PDFDownloader, DownloadError, downloader as shared_downloader
+from history_store import HistoryStore, arxiv_id_from_link
+from listing_cache import ListingCache
+from peewee import SqliteDatabase
+from lxml import html, etree
+from metrics import metrics
+import hashlib
 import os
-import httpx, contextlib, json
+import tempfile
+import httpx, json
 import asyncio
+import inspect
+import time
 
 
 
+PDF_LINK_XPATH = ".//span[@class = 'list-identifier']//a[@title = 'Download PDF']"
+TITLE_XPATH = './/div[@class = "list-title mathjax"]'
+AUTHORS_XPATH = './/div[@class = "list-authors"]//a'
+ABSTRACT_XPATH = './/p[@class = "mathjax"]'
+ARXIV_API_URL = "https://export.arxiv.org/api/query"
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+def clean_title(title: str) -> str:
+    return title.replace("Title:", "").strip().replace(" ", "-")[:100]
+
+
+def paper_details(block: html.HtmlElement) -> Dict[str, dict]:
+    # Listings put the links in <dt> and title, authors and, on the "new"
+    # listings only, the abstract in the <dd> that follows. Each paper is
+    # read from its own pair, so entries without a PDF link (withdrawn
+    # papers) cannot shift the titles of the ones after them.
+    details = {}
+    for entry in block.xpath("./dt"):
+        links = entry.xpath(PDF_LINK_XPATH)
+        description = entry.getnext()
+        if not links or description is None or description.tag != "dd":
+            continue
+        title = description.xpath(TITLE_XPATH)
+        abstract = description.xpath(ABSTRACT_XPATH)
+        details[f'https://arxiv.org{links[0].get("href")}.pdf'] = {
+            "title": clean_title(title[0].text_content()) if title else "",
+            "authors": [author.text_content().strip() for author in description.xpath(AUTHORS_XPATH)],
+            "abstract": " ".join(abstract[0].text_content().split()) if abstract else "",
+        }
+    return details
+
+
+class ListingParser:
+    def __init__(self) -> None:
+        self.parser = etree.HTMLPullParser(events=("end",), tag=("h3", "dl"))
+        self.parser.set_element_class_lookup(html.HtmlElementClassLookup())
+        self.links: Dict[str, Set[str]] = {}
+        self.pending_dates: List[str] = []
+        self.seen_date = False
+        self.details: Dict[str, dict] = {}
+        # Listing entries seen, with or without a PDF link.
+        self.entries = 0
+
+    def feed(self, data: bytes) -> List[Tuple[str, str, str]]:
+        self.parser.feed(data)
+        return self.read_records()
+
+    def close(self) -> List[Tuple[str, str, str]]:
+        self.parser.close()
+        records = self.read_records()
+        # Dates after the last <dl> have no papers, parse_page lists them empty.
+        for date in self.pending_dates:
+            self.links[date] = set()
+        self.pending_dates = []
+        return records
+
+    def read_records(self) -> List[Tuple[str, str, str]]:
+        records = []
+        for _, element in self.parser.read_events():
+            if element.tag == "h3":
+                self.pending_dates.append(element.text_content())
+                self.seen_date = True
+            elif self.seen_date:
+                records.extend(self.process_block(element))
+                self.release(element)
+        return records
+
+    def process_block(self, block: html.HtmlElement) -> List[Tuple[str, str, str]]:
+        block_links = [
+            f'https://arxiv.org{paper.get("href")}.pdf'
+            for paper in block.xpath(PDF_LINK_XPATH)
+        ]
+        for date in self.pending_dates:
+            self.links[date] = set(block_links)
+        block_date = self.pending_dates[-1] if self.pending_dates else ""
+        self.pending_dates = []
+
+        block_details = paper_details(block)
+        self.details.update(block_details)
+        self.entries += len(block.xpath("./dt"))
+        return [(block_date, link, details["title"]) for link, details in block_details.items()]
+
+    def release(self, element: html.HtmlElement) -> None:
+        element.clear(keep_tail=True)
+        parent = element.getparent()
+        if parent is None:
+            return
+        while element.getprevious() is not None:
+            del parent[0]
+
+
 class ArxivScraper:
-    def __init__(self, history_file: str, pages: int, selector_file: str) -> None:
-        self.history_file = history_file
-        self.history = self.read_history_file(history_file)
+    def __init__(
+        self,
+        history: HistoryStore,
+        pages: int,
+        selector_file: str,
+        streaming: bool = True,
+        page_size: int = 0,
+        listing_cache: ListingCache | None = None,
+        downloader: PDFDownloader | None = None,
+    ) -> None:
+        self.history = history
         self.selectors = self.read_selector_file(selector_file)
         self.pages = pages
-        self.session = httpx.AsyncClient()        
-
-    def read_history_file(self, filename: str) -> Set[str]:
-        with contextlib.suppress(FileNotFoundError):
-            with open(filename, "rt") as fp:
-                return {line.strip() for line in fp.readlines()}
-        return set()
-
-    def write_history_file(self, history: Set[str]) -> None:
-        history = [f"{line}\n" for line in history]
-        with open(self.history_file, "wt") as fp:
-            fp.writelines(history)
+        self.streaming = streaming
+        self.page_size = page_size
+        self.listing_cache = listing_cache
+        self.downloader = downloader or shared_downloader
+        self.session = self.downloader.client
+        self.details: Dict[str, dict] = {}
 
     def read_selector_file(self, filename: str) -> Dict[str, str]:
         selector_schema = {
@@ -45,71 +148,194 @@ class ArxivScraper:
         except Exception as e:
             print(f"Error reading the selector file. Details {e}")
 
-    async def download_pdf_async(
-        self, link: str, filename: str, semaphore: asyncio.Semaphore
-    ) -> None:
-        async with semaphore:
-            response = await self.session.get(link)
-            with open(filename, "wb") as f:
-                f.write(response.content)
-
-    async def start(self, max_concurrency=5, days_limit=2, pdf_limit=10) -> list[dict[str, str]]:
-        if not os.path.exists("pdfs"):
-            os.makedirs("pdfs")
-                    
-        self.history = self.read_history_file(self.history_file)
+    async def download_pdf_async(self, link: str, filename: str) -> bool:
+        try:
+            await self.downloader.download(link, filename)
+        except DownloadError as e:
+            print(e)
+            return False
+        return True
 
-        link_dict, title_dict = await self.scrape_page(self.selectors["baseUrl"])
-        
-        filtered_dict = self.get_closest_items(link_dict, days_limit)
-        
-        all_links = set()
-        all_files = []
-        
-        pdfs_downloaded_count = 0
-        stop_processing = False
+    async def download_worker(
+        self,
+        queue: asyncio.Queue,
+        downloaded: list[dict[str, str]],
+        on_downloaded: Callable[[dict[str, str]], Any] | None,
+    ) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                if not await self.download_pdf_async(item["link"], item["file_path"]):
+                    continue
+                downloaded.append(item)
+                if on_downloaded is not None:
+                    try:
+                        result = on_downloaded(item)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as e:
+                        print(f"Error handling {item['link']}. Details {e}")
+            finally:
+                queue.task_done()
 
+    def new_items(
+        self,
+        filtered_dict: Dict[str, Set[str]],
+        title_dict: Dict[str, str],
+        pdf_limit: int,
+    ) -> list[dict[str, str]]:
+        items = []
         for date, links in filtered_dict.items():
-            to_get = links.difference(self.history)
-            tasks = []
-            semaphore = asyncio.Semaphore(max_concurrency)
-            
-            for link in to_get:
-                if stop_processing:
-                    break # break out of the outer loop
-                
-                print(f"Queuing {link} for download")
-                title = title_dict[link]
+            for link in self.history.filter_new(links):
+                if len(items) >= pdf_limit:
+                    return items
+
+                title = title_dict.get(link, "")
                 filename = f"{link.split('/')[-1][:-4]}__{self.string_to_date_string(date)}__{title}.pdf"
                 filepath = os.path.join("pdfs", filename)
-                
-                all_files.append({"file_path" : filepath, "title" : title, "link" : link})
-                
-                task = asyncio.create_task(
-                    self.download_pdf_async(
-                        link,
-                        filepath,
-                        semaphore,
-                    )
+                items.append(
+                    {"file_path" : filepath, "title" : title, "link" : link, "category" : self.category()}
                 )
-                pdfs_downloaded_count += 1 
-                if pdfs_downloaded_count >= pdf_limit:
-                    stop_processing = True 
-                    break 
-                
-                tasks.append(task)
-
-            all_links.update(links)
-            
-            if stop_processing:
-                break 
+        return items
+
+    async def queue_downloads(
+        self,
+        queue: asyncio.Queue,
+        filtered_dict: Dict[str, Set[str]],
+        title_dict: Dict[str, str],
+        pdf_limit: int,
+    ) -> None:
+        for item in self.new_items(filtered_dict, title_dict, pdf_limit):
+            await queue.put(item)
+            metrics.inc("downloads_queued_total")
+
+    async def fetch_details(self, links: List[str], batch_size: int = 100) -> Dict[str, dict]:
+        # Fallback for listings without abstracts, one arXiv API request
+        # per batch of ids.
+        details = {}
+        for start in range(0, len(links), batch_size):
+            batch = {arxiv_id_from_link(link): link for link in links[start:start + batch_size]}
+            try:
+                response = await self.session.get(
+                    ARXIV_API_URL,
+                    params={"id_list": ",".join(batch), "max_results": len(batch)},
+                )
+                response.raise_for_status()
+                feed = etree.fromstring(response.content)
+            except (httpx.HTTPError, etree.XMLSyntaxError) as e:
+                print(f"Error fetching abstracts. Details {e}")
+                continue
+            for entry in feed.iter(f"{ATOM}entry"):
+                entry_id = entry.findtext(f"{ATOM}id", "").rsplit("/abs/", 1)[-1]
+                link = batch.get(entry_id) or batch.get(entry_id.rsplit("v", 1)[0])
+                if link is None:
+                    continue
+                details[link] = {
+                    "authors": [
+                        name.text.strip() for name in entry.iter(f"{ATOM}name") if name.text
+                    ],
+                    "abstract": " ".join(entry.findtext(f"{ATOM}summary", "").split()),
+                }
+        return details
+
+    async def add_details(self, items: list[dict]) -> None:
+        missing = [
+            item["link"] for item in items
+            if not self.details.get(item["link"], {}).get("abstract")
+        ]
+        if missing:
+            self.details.update(await self.fetch_details(missing))
+        for item in items:
+            details = self.details.get(item["link"], {})
+            item["arxiv_id"] = arxiv_id_from_link(item["link"])
+            item["authors"] = details.get("authors", [])
+            item["abstract"] = details.get("abstract", "")
+
+    async def scrape_new(
+        self, days_limit: int, max_concurrency: int
+    ) -> Tuple[Dict[str, Set[str]], Dict[str, str], Set[str]]:
+        if self.page_size:
+            link_dict, title_dict = await self.scrape_pages(
+                self.selectors["baseUrl"], days_limit, max_concurrency
+            )
+        else:
+            link_dict, title_dict = await self.scrape_page(self.selectors["baseUrl"])
 
-        await asyncio.gather(*tasks)
-        links = self.history.union(all_links)
-        self.write_history_file(links)
+        filtered_dict = self.get_closest_items(link_dict, days_limit)
+        listed = set().union(*filtered_dict.values())
+
+        if self.listing_cache is not None:
+            new_links = self.listing_cache.new_links(self.selectors["baseUrl"], listed)
+            filtered_dict = {
+                date: links.intersection(new_links)
+                for date, links in filtered_dict.items()
+            }
+        return filtered_dict, title_dict, listed
+
+    def mark_handled(self, links: Set[str], listed: Set[str]) -> None:
+        self.history.add_many(links)
+        if self.listing_cache is not None:
+            self.listing_cache.mark_seen(self.selectors["baseUrl"], links, listed)
+            self.listing_cache.save()
+
+    async def discover(
+        self, max_concurrency=5, days_limit=2, pdf_limit=10
+    ) -> list[dict[str, str]]:
+        # New papers with title, authors and abstract, without downloading
+        # anything. The PDF is only fetched once somebody asks for it.
+        if not os.path.exists("pdfs"):
+            os.makedirs("pdfs")
+
+        with metrics.span("scrape"):
+            filtered_dict, title_dict, listed = await self.scrape_new(days_limit, max_concurrency)
+            items = self.new_items(filtered_dict, title_dict, pdf_limit)
+            await self.add_details(items)
+        metrics.inc("papers_discovered_total", len(items))
+        self.mark_handled({item["link"] for item in items}, listed)
+        return items
+
+    async def start(
+        self,
+        max_concurrency=5,
+        days_limit=2,
+        pdf_limit=10,
+        on_downloaded: Callable[[dict[str, str]], Any] | None = None,
+    ) -> list[dict[str, str]]:
+        if not os.path.exists("pdfs"):
+            os.makedirs("pdfs")
+
+
+        with metrics.span("scrape"):
+            filtered_dict, title_dict, listed = await self.scrape_new(days_limit, max_concurrency)
+        if not any(filtered_dict.values()):
+            if self.listing_cache is not None:
+                self.listing_cache.save()
+            return []
+
+        # One bounded queue feeds a fixed pool of workers, so max_concurrency
+        # and pdf_limit hold across all dates and each finished download is
+        # handed to on_downloaded without waiting for the rest.
+        queue = asyncio.Queue(maxsize=max_concurrency * 2)
+        downloaded = []
+        workers = [
+            asyncio.create_task(self.download_worker(queue, downloaded, on_downloaded))
+            for _ in range(max_concurrency)
+        ]
+        try:
+            await self.queue_downloads(queue, filtered_dict, title_dict, pdf_limit)
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
 
-        return all_files
+        self.mark_handled({item["link"] for item in downloaded}, listed)
+        return downloaded
 
+    def category(self) -> str:
+        path = httpx.URL(self.selectors["baseUrl"]).path
+        return path.split("/list/", 1)[-1].split("/", 1)[0] if "/list/" in path else ""
 
     def string_to_date_string(self, string: str) -> str:
         date_obj = datetime.strptime(string, "%a, %d %b %Y")
@@ -123,10 +349,115 @@ class ArxivScraper:
     def string_to_date(self, string: str) -> datetime:
         return datetime.strptime(string, "%a, %d %b %Y")
 
+    async def stream_page(self, link: str) -> AsyncIterator[Tuple[str, str, str]]:
+        parser = ListingParser()
+        async for record in self.stream_listing(link, parser):
+            yield record
+
+    async def stream_listing(
+        self, link: str, parser: ListingParser
+    ) -> AsyncIterator[Tuple[str, str, str]]:
+        async with self.session.stream("GET", link) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                for record in parser.feed(chunk):
+                    yield record
+        for record in parser.close():
+            yield record
+
     async def scrape_page(self, link: str) -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
-        request = await self.session.get(link)
-        page = request.content
-        tree = html.fromstring(page)
+        links, title_dict, _ = await self.fetch_listing(link)
+        return links, title_dict
+
+    async def fetch_listing(self, link: str) -> Tuple[Dict[str, Set[str]], Dict[str, str], int]:
+        # The parsed listing and how many entries it had.
+        headers = self.listing_cache.request_headers(link) if self.listing_cache else {}
+        while True:
+            async with self.session.stream("GET", link, headers=headers) as response:
+                if response.status_code == 304 and headers:
+                    cached = self.listing_cache.get_listing(link)
+                    if cached is not None:
+                        return cached
+                    # Nothing cached to reuse, ask again without validators.
+                    headers = {}
+                    continue
+                # An error page would parse as an empty listing and wipe the
+                # seen links, so it is never parsed or cached.
+                response.raise_for_status()
+                result, digest = await self.read_listing(link, response)
+            break
+
+        if self.listing_cache is not None:
+            self.listing_cache.store_listing(link, response, digest, *result)
+        return result
+
+    async def read_listing(
+        self, link: str, response: httpx.Response
+    ) -> Tuple[Tuple[Dict[str, Set[str]], Dict[str, str], int], str]:
+        cached = self.listing_cache.get_listing(link) if self.listing_cache else None
+        if self.streaming and cached is None:
+            # Nothing to compare against, so parse while the body arrives.
+            digest = hashlib.sha256()
+            return await self.parse_stream(response.aiter_bytes(), digest), digest.hexdigest()
+
+        if self.streaming:
+            # Hashed as it arrives and spooled to disk, so memory stays
+            # bounded by the chunk size and an unchanged listing is not parsed.
+            with tempfile.TemporaryFile() as spool:
+                digest = hashlib.sha256()
+                async for chunk in response.aiter_bytes():
+                    digest.update(chunk)
+                    spool.write(chunk)
+                digest = digest.hexdigest()
+                unchanged = self.listing_cache.digest_matches(link, digest)
+                metrics.cache("listing", hits=unchanged, misses=not unchanged)
+                if unchanged:
+                    return cached, digest
+                spool.seek(0)
+                return await self.parse_stream(self.read_chunks(spool)), digest
+
+        # Buffer and hash the body first, an unchanged listing is not parsed.
+        page = await response.aread()
+        digest = hashlib.sha256(page).hexdigest()
+        if cached is not None:
+            unchanged = self.listing_cache.digest_matches(link, digest)
+            metrics.cache("listing", hits=unchanged, misses=not unchanged)
+            if unchanged:
+                return cached, digest
+
+        with metrics.span("parse"):
+            tree = html.fromstring(page)
+            result = *self.parse_tree(tree), len(tree.xpath("//h3/following-sibling::dl/dt"))
+        return result, digest
+
+    async def read_chunks(self, fp, size: int = 65536) -> AsyncIterator[bytes]:
+        for chunk in iter(lambda: fp.read(size), b""):
+            yield chunk
+
+    async def parse_stream(
+        self, chunks: AsyncIterator[bytes], digest=None
+    ) -> Tuple[Dict[str, Set[str]], Dict[str, str], int]:
+        parser = ListingParser()
+        title_dict = {}
+        parse_time = 0.0
+        async for chunk in chunks:
+            if digest is not None:
+                digest.update(chunk)
+            start = time.perf_counter()
+            for _, pdf_link, title in parser.feed(chunk):
+                title_dict[pdf_link] = title
+            parse_time += time.perf_counter() - start
+        start = time.perf_counter()
+        for _, pdf_link, title in parser.close():
+            title_dict[pdf_link] = title
+        metrics.observe("span_seconds", parse_time + time.perf_counter() - start, span="parse")
+        self.details.update(parser.details)
+        return parser.links, title_dict, parser.entries
+
+    def parse_page(self, page: bytes) -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
+        return self.parse_tree(html.fromstring(page))
+
+    def parse_tree(self, tree: html.HtmlElement) -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
         dates = tree.xpath("//h3")
         links = {}
         
@@ -141,20 +472,66 @@ class ArxivScraper:
                 for paper in research_papers_pdfs
             }
             
-        research_papers_pdfs = tree.xpath(
-            "//following-sibling::dl[1][preceding-sibling::h3[1]]//span[@class = 'list-identifier']//a[@title = 'Download PDF']"
-        )
-        titles = tree.xpath(
-            '//following-sibling::dl[1][preceding-sibling::h3[1]]//div[@class = "list-title mathjax"]'
-        )
-
-        title_dict = {f'https://arxiv.org{paper.get("href")}.pdf' : title.text_content().replace("Title:", "").strip().replace(" ", "-")[:100] for title, paper in zip(titles, research_papers_pdfs)}
+        title_dict = {}
+        for block in tree.xpath("//dl"):
+            block_details = paper_details(block)
+            self.details.update(block_details)
+            if block.xpath("preceding-sibling::h3"):
+                title_dict.update(
+                    (link, details["title"]) for link, details in block_details.items()
+                )
 
         return links, title_dict
 
+    def page_url(self, link: str, skip: int) -> str:
+        url = httpx.URL(link).copy_set_param("skip", skip)
+        return str(url.copy_set_param("show", self.page_size))
+
+    async def scrape_window(
+        self, link: str, skip: int, semaphore: asyncio.Semaphore
+    ) -> Tuple[Dict[str, Set[str]], Dict[str, str], int]:
+        async with semaphore:
+            return await self.fetch_listing(self.page_url(link, skip))
+
+    async def scrape_pages(
+        self, link: str, days_limit: int, max_concurrency: int = 5
+    ) -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
+        # Fetches `pages` windows of `page_size` entries per round. The listing
+        # is ordered newest first, so once more than `days_limit` dates have
+        # been seen every later window falls outside get_closest_items.
+        semaphore = asyncio.Semaphore(max_concurrency)
+        links: Dict[str, Set[str]] = {}
+        title_dict: Dict[str, str] = {}
+        skip = 0
+
+        while True:
+            windows = await asyncio.gather(
+                *(
+                    self.scrape_window(link, skip + i * self.page_size, semaphore)
+                    for i in range(max(self.pages, 1))
+                )
+            )
+            skip += max(self.pages, 1) * self.page_size
+            exhausted = False
+
+            for page_links, page_titles, entries in windows:
+                for date, date_links in page_links.items():
+                    links.setdefault(date, set()).update(date_links)
+                title_dict.update(page_titles)
+                # Entries, not PDF links, a full window can hold papers
+                # without a PDF.
+                if entries < self.page_size:
+                    exhausted = True
+
+            if exhausted or len(links) > days_limit:
+                return links, title_dict
+
 
 async def main():
-    scraper = ArxivScraper("history_file.txt", 2, "selectors.json")
+    history = HistoryStore(
+        SqliteDatabase("database/names.db"), legacy_file="history_file.txt"
+    )
+    scraper = ArxivScraper(history, 2, "selectors.json", page_size=250)
     await scraper.start()
 
 
@@ -0,0 +1,123 @@
+"""Chat throughput against a fake OpenAI endpoint and a fake vector store."""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from langchain.chat_models import ChatOpenAI
+from peewee import SqliteDatabase
+
+from answer_cache import AnswerCache
+from benchmarks.fakes import FakeEmbeddings, FakeOpenAIServer, FakeVectorStore
+from data_storage import ChatManager
+from openai_utils import ChatRetrievalWithDB, close_shared_aiosession
+
+QUESTION = "What dataset do the authors use to evaluate the retrieval model"
+
+
+def make_store(chunks: int) -> FakeVectorStore:
+    store = FakeVectorStore(FakeEmbeddings())
+    store.add_texts(
+        [f"Chunk {i} describes the dataset, the model and the evaluation {i % 7}" for i in range(chunks)],
+        metadatas=[{"page": i} for i in range(chunks)],
+    )
+    return store
+
+
+def make_chat(server, store, chat_manager, session: str, answer_cache=None) -> ChatRetrievalWithDB:
+    def llm(streaming: bool) -> ChatOpenAI:
+        return ChatOpenAI(
+            openai_api_key="fake",
+            openai_api_base=server.api_base,
+            streaming=streaming,
+            max_retries=0,
+        )
+
+    return ChatRetrievalWithDB(
+        "bench", "bench", FakeEmbeddings(), llm(True), chat_manager,
+        session=session, condense_llm=llm(False), vectorstore=store, answer_cache=answer_cache,
+    )
+
+
+async def run_blocking(server, store, chat_manager, chats: int) -> list:
+    latencies = []
+    for i in range(chats):
+        chat = make_chat(server, store, chat_manager, f"blocking-{i}")
+        start = time.perf_counter()
+        chat.chat(f"{QUESTION} {i}")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def run_async(
+    server, store, chat_manager, chats: int, concurrency: int, answer_cache=None, questions: int = 0
+) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int) -> None:
+        chat = make_chat(
+            server, store, chat_manager, f"async-{concurrency}-{i}-{id(answer_cache)}", answer_cache
+        )
+        question = f"{QUESTION} {i % questions if questions else i}"
+        async with semaphore:
+            start = time.perf_counter()
+            tokens = []
+
+            async def on_text(text: str) -> None:
+                tokens.append(text)
+
+            await chat.achat(question if i % 2 else f"{question.upper()}?", on_text=on_text)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(chats)))
+    return latencies
+
+
+def report(name: str, latencies: list, elapsed: float) -> None:
+    print(
+        f"{name:<14} {len(latencies) / elapsed:7.2f} chats/s  "
+        f"p50={statistics.median(latencies) * 1000:7.0f}ms  wall={elapsed:6.2f}s"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--vector-latency", type=float, default=0.05)
+    parser.add_argument("--questions", type=int, default=4)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=args.latency).start()
+    store = make_store(200)
+    store.latency = args.vector_latency
+    with tempfile.TemporaryDirectory() as directory:
+        chat_manager = ChatManager(SqliteDatabase(os.path.join(directory, "bench.db")))
+
+        start = time.perf_counter()
+        latencies = await run_blocking(server, store, chat_manager, max(1, args.chats // 4))
+        report("blocking", latencies, time.perf_counter() - start)
+
+        for concurrency in args.concurrency:
+            start = time.perf_counter()
+            latencies = await run_async(server, store, chat_manager, args.chats, concurrency)
+            report(f"async x{concurrency}", latencies, time.perf_counter() - start)
+
+        answer_cache = AnswerCache()
+        start = time.perf_counter()
+        latencies = await run_async(
+            server, store, chat_manager, args.chats, args.concurrency[-1], answer_cache, args.questions
+        )
+        report(f"cached x{args.concurrency[-1]}", latencies, time.perf_counter() - start)
+        print(f"answer cache: {answer_cache.stats.describe()}")
+
+    await close_shared_aiosession()
+    server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
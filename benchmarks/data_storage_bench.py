@@ -0,0 +1,94 @@
+"""Query timings for data_storage on 100k chat messages and 10k PDFs."""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from peewee import SqliteDatabase
+
+from data_storage import SQLITE_PRAGMAS, ChatManager, PDFFileManager
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def report(name: str, before: float, after: float) -> None:
+    print(
+        f"{name:<34} before={before * 1000:9.3f}ms after={after * 1000:9.3f}ms "
+        f"speedup={before / max(after, 1e-9):8.1f}x"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--pdfs", type=int, default=10_000)
+    parser.add_argument("--namespaces", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = SqliteDatabase(os.path.join(directory, "bench.db"), pragmas=SQLITE_PRAGMAS)
+        chat_manager = ChatManager(db)
+        pdf_manager = PDFFileManager(db)
+
+        start = time.perf_counter()
+        per_namespace = args.messages // args.namespaces
+        for n in range(args.namespaces):
+            chat_manager.add_messages(
+                f"namespace-{n}",
+                ((f"answer {i}", f"question {i}") for i in range(per_namespace)),
+            )
+        pdf_manager.create_pdf_files(
+            (f"namespace-{i}", f"pdfs/{i}.pdf", f"Paper {i}") for i in range(args.pdfs)
+        )
+        print(f"bulk insert of {args.messages} messages and {args.pdfs} pdfs: "
+              f"{time.perf_counter() - start:.2f}s")
+
+        namespace = f"namespace-{args.namespaces // 2}"
+        table = chat_manager.model._meta.table_name
+
+        def last_sequence_unindexed():
+            db.execute_sql(
+                f'SELECT * FROM "{table}" NOT INDEXED WHERE namespace = ? '
+                "ORDER BY sequence_number DESC LIMIT 1",
+                (namespace,),
+            ).fetchall()
+
+        report(
+            "next sequence number",
+            timed(last_sequence_unindexed, args.repeat),
+            timed(lambda: chat_manager.next_sequence_number(namespace, ""), args.repeat),
+        )
+
+        def history_unindexed():
+            db.execute_sql(
+                f'SELECT * FROM "{table}" NOT INDEXED WHERE namespace = ? '
+                "ORDER BY sequence_number",
+                (namespace,),
+            ).fetchall()
+
+        report(
+            "chat history (all vs window of 12)",
+            timed(history_unindexed, args.repeat),
+            timed(lambda: chat_manager.retrieve_recent_messages(namespace, "", 12), args.repeat),
+        )
+
+        middle = args.pdfs // 2
+        report(
+            "pdf listing (all vs one page)",
+            timed(pdf_manager.get_all_pdfs, args.repeat),
+            timed(lambda: pdf_manager.get_pdfs_page(middle, 10), args.repeat),
+        )
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Cold vs warm per-message embedding latency."""
+import argparse
+import statistics
+import time
+
+from embeddings import DEFAULT_MODEL_NAME, EmbeddingService
+
+MESSAGE = "What dataset do the authors use to evaluate the retrieval model?"
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def report(name: str, samples: list) -> None:
+    print(
+        f"{name:<28} n={len(samples):<4} "
+        f"p50={statistics.median(samples) * 1000:8.1f}ms "
+        f"p99={percentile(samples, 0.99) * 1000:8.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--reloads", type=int, default=3)
+    args = parser.parse_args()
+
+    # What every !chat message used to pay: a fresh model per call.
+    reload_samples = []
+    for _ in range(args.reloads):
+        start = time.perf_counter()
+        EmbeddingService(args.model, args.batch_size, args.backend).embed_query(MESSAGE)
+        reload_samples.append(time.perf_counter() - start)
+
+    service = EmbeddingService(args.model, args.batch_size, args.backend)
+    start = time.perf_counter()
+    service.embed_query(MESSAGE)
+    cold = time.perf_counter() - start
+
+    warm_samples = []
+    for i in range(args.messages):
+        start = time.perf_counter()
+        service.embed_query(f"{MESSAGE} ({i})")
+        warm_samples.append(time.perf_counter() - start)
+
+    report("reload per message", reload_samples)
+    report("shared service, cold", [cold])
+    report("shared service, warm", warm_samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""End-to-end run of the bot's pipeline against local stand-ins."""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+from langchain.chat_models import ChatOpenAI
+from peewee import SqliteDatabase
+
+import embeddings
+import openai_utils
+from arxiv_scraper import ArxivScraper
+from benchmarks.fakes import (
+    FakeArxivServer,
+    FakeChannel,
+    FakeEmbeddings,
+    FakeOpenAIServer,
+    LocalTransport,
+    offline_tiktoken,
+)
+from data_storage import ChatManager
+from downloader import PDFDownloader
+from globals import config
+from history_store import HistoryStore
+from message_scheduler import MessageScheduler, StreamedReply
+from metrics import llm_usage, metrics
+from openai_utils import ChatSessionManager, add_pdf_to_memory, summarize_pdf
+from summarization import SummaryEngine
+from utils import create_pdf_embed
+
+QUESTIONS = [
+    "What problem does this paper address",
+    "Which dataset is used for the evaluation",
+    "How does the proposed method compare to the baseline",
+    "What are the main limitations",
+]
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stage_result(latencies: list, wall: float) -> dict:
+    return {
+        "count": len(latencies),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_s": round(len(latencies) / wall, 3) if wall else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else 0.0,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def scrape(args, arxiv: FakeArxivServer, workdir: str) -> tuple:
+    downloader = PDFDownloader(max_connections=args.download_concurrency)
+    downloader.client = httpx.AsyncClient(transport=LocalTransport(arxiv.port), follow_redirects=True)
+    history = HistoryStore(SqliteDatabase(os.path.join(workdir, "history.db")))
+    scraper = ArxivScraper(history, 2, args.selectors, page_size=args.page_size, downloader=downloader)
+
+    latencies = []
+    start = time.perf_counter()
+    downloaded = await scraper.start(
+        max_concurrency=args.download_concurrency,
+        days_limit=args.days,
+        pdf_limit=args.papers,
+        on_downloaded=lambda item: latencies.append(time.perf_counter() - start),
+    )
+    wall = time.perf_counter() - start
+    await downloader.aclose()
+    for item in downloaded:
+        item.update(scraper.details.get(item["link"], {}))
+    return downloaded, stage_result(latencies, wall)
+
+
+async def notify(args, papers: list) -> dict:
+    channel = FakeChannel(latency=args.discord_latency)
+    scheduler = MessageScheduler(channel.name)
+    scheduler.get_channel = lambda: channel
+    start = time.perf_counter()
+    for paper in papers:
+        scheduler.post_digest(
+            create_pdf_embed(
+                summary=paper.get("abstract", ""), link=paper["link"], title=paper["title"], authors=paper.get("authors")
+            ),
+            paper,
+        )
+    await scheduler.drain()
+    wall = time.perf_counter() - start
+    for worker in scheduler.workers.values():
+        worker.cancel()
+    result = stage_result([sent_at - start for sent_at, _ in channel.sent], wall)
+    result["papers"] = len(papers)
+    return result
+
+
+async def in_threads(workers: int, fn, items: list) -> tuple:
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        result = fn(item)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        results = await asyncio.gather(*(loop.run_in_executor(pool, timed, item) for item in items))
+    return results, stage_result(latencies, time.perf_counter() - start)
+
+
+async def chat_stage(args, server: FakeOpenAIServer, workdir: str, namespaces: list) -> dict:
+    # The bot's !chat path: warm sessions from a ChatSessionManager, achat
+    # streaming tokens into a StreamedReply on the (fake) channel.
+    chat_manager = ChatManager(SqliteDatabase(os.path.join(workdir, "chat.db")))
+    chat_sessions = ChatSessionManager(
+        "bench",
+        embeddings.get_embeddings(),
+        ChatOpenAI(
+            openai_api_key="fake", openai_api_base=server.api_base, max_retries=0,
+            streaming=True, callbacks=[llm_usage],
+        ),
+        chat_manager,
+        condense_llm=ChatOpenAI(
+            openai_api_key="fake", openai_api_base=server.api_base, max_retries=0, callbacks=[llm_usage]
+        ),
+        answer_cache=openai_utils.answer_cache,
+    )
+    channel = FakeChannel(latency=args.discord_latency)
+    scheduler = MessageScheduler(channel.name)
+    scheduler.get_channel = lambda: channel
+    semaphore = asyncio.Semaphore(args.chat_concurrency)
+    sessions = max(1, args.chats // args.turns)
+    latencies, answer_latencies, first_tokens = [], [], []
+
+    async def run_session(number: int) -> None:
+        async with semaphore:
+            chat = chat_sessions.get(namespaces[number % len(namespaces)], f"bench-{number}")
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                first = []
+                reply = StreamedReply(scheduler)
+                await reply.start()
+
+                async def on_text(text: str) -> None:
+                    if not first:
+                        first.append(time.perf_counter() - start)
+                    await reply.update(text)
+
+                answer_start = time.perf_counter()
+                answer = await chat.achat(f"{QUESTIONS[(number + turn) % len(QUESTIONS)]} {number}?", on_text=on_text)
+                answer_latencies.append(time.perf_counter() - answer_start)
+                await reply.finish(answer)
+                latencies.append(time.perf_counter() - start)
+                first_tokens.extend(first)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(number) for number in range(sessions)))
+    result = stage_result(latencies, time.perf_counter() - start)
+    await scheduler.drain()
+    for worker in scheduler.workers.values():
+        worker.cancel()
+    result["first_token_p50_ms"] = round(statistics.median(first_tokens) * 1000, 1) if first_tokens else 0.0
+    result["achat_p50_ms"] = round(statistics.median(answer_latencies) * 1000, 1) if answer_latencies else 0.0
+    result["achat_p99_ms"] = round(percentile(answer_latencies, 0.99) * 1000, 1) if answer_latencies else 0.0
+    return result
+
+
+def compare(results: dict, baseline_file: str) -> None:
+    with open(baseline_file, "rt") as fp:
+        baseline = json.load(fp)
+    for name, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("throughput_per_s", "p50_ms", "p99_ms", "peak_rss_mb"):
+            if before.get(key):
+                changes.append(f"{key} {(stage[key] - before[key]) / before[key]:+.0%}")
+        print(f"{name:<10} vs {baseline.get('commit') or baseline_file}: {', '.join(changes)}")
+
+
+async def run(args, workdir: str) -> dict:
+    arxiv = FakeArxivServer(args.pdf, papers=args.papers, days=args.days, latency=args.arxiv_latency).start()
+    server = FakeOpenAIServer(latency=args.llm_latency, token_delay=args.token_delay).start()
+
+    # Swap the module singletons for local stand-ins before anything uses them.
+    config["VECTOR_STORE"] = "memory"
+    if not args.real_embeddings:
+        embeddings.embedding_service = FakeEmbeddings()
+    openai_utils.summary_engine = SummaryEngine(
+        ChatOpenAI(openai_api_key="fake", openai_api_base=server.api_base, max_retries=0, callbacks=[llm_usage]),
+        SqliteDatabase(os.path.join(workdir, "summaries.db")),
+        max_concurrency=config.get("SUMMARY_CONCURRENCY", 4),
+    )
+
+    stages = {}
+    try:
+        papers, stages["scrape"] = await scrape(args, arxiv, workdir)
+        print(f"scrape     {stages['scrape']}")
+        stages["notify"] = await notify(args, papers)
+        print(f"notify     {stages['notify']}")
+
+        ingested, stages["ingest"] = await in_threads(
+            args.ingest_workers, lambda paper: add_pdf_to_memory(paper["file_path"]), papers
+        )
+        print(f"ingest     {stages['ingest']}")
+        _, stages["summarize"] = await in_threads(
+            args.ingest_workers, lambda result: summarize_pdf(result[1]), ingested
+        )
+        print(f"summarize  {stages['summarize']}")
+
+        stages["chat"] = await chat_stage(args, server, workdir, [namespace for namespace, _ in ingested])
+        print(f"chat       {stages['chat']}")
+    finally:
+        await openai_utils.close_shared_aiosession()
+        server.stop()
+        arxiv.stop()
+
+    return {
+        "benchmark": "end_to_end",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "stages": stages,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "llm_requests": server.requests,
+        "spans": {
+            name: {"count": count, "total_seconds": round(total, 3), "p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1)}
+            for name, count, total, p50, p95 in metrics.span_summary()
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--papers", type=int, default=20)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--pdf", nargs="+", default=[])
+    parser.add_argument("--page-size", type=int, default=250)
+    parser.add_argument("--download-concurrency", type=int, default=5)
+    parser.add_argument("--ingest-workers", type=int, default=2)
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--chat-concurrency", type=int, default=8)
+    parser.add_argument("--arxiv-latency", type=float, default=0.02)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--real-embeddings", action="store_true")
+    parser.add_argument("--real-tokenizer", action="store_true")
+    parser.add_argument("--output", default="")
+    parser.add_argument("--baseline", default="")
+    args = parser.parse_args()
+    if not args.real_tokenizer:
+        offline_tiktoken()
+    args.pdf = [os.path.abspath(path) for path in args.pdf]
+    args.selectors = os.path.abspath("selectors.json")
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"end_to_end-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    output = os.path.abspath(output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else ""
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # pdfs/, caches and the keyword index are relative paths, they all
+        # land in the scratch directory.
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(run(args, workdir))
+        finally:
+            os.chdir(cwd)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "wt") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"peak RSS {results['peak_rss_mb']}MB, results written to {output}")
+    if baseline:
+        compare(results, baseline)
+    if results["stages"]["scrape"]["count"] < args.papers:
+        sys.exit(f"only {results['stages']['scrape']['count']} of {args.papers} papers were downloaded")
+
+
+if __name__ == "__main__":
+    main()
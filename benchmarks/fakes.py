@@ -0,0 +1,355 @@
+"""Local stand-ins for the services the bot talks to, for benchmarks."""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from html import escape
+from typing import Any, List, Optional
+
+import httpx
+import tiktoken
+import tiktoken.model
+from aiohttp import web
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+from vector_stores import InMemoryVectorStore
+
+
+class FakeLLM(LLM):
+    # Answers after a fixed latency with the last words of the prompt, so
+    # outputs are deterministic and shorter than their inputs.
+    latency: float = 0.2
+    words: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+        return f"[{digest}] " + " ".join(prompt.split()[-self.words:])
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+def offline_tiktoken() -> tiktoken.Encoding:
+    # tiktoken downloads its BPE files on first use. A byte-level encoding
+    # stands in for every model, so counts run higher than the real ones.
+    encoding = tiktoken.Encoding(
+        "offline",
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256},
+    )
+    tiktoken.get_encoding = lambda name: encoding
+    tiktoken.encoding_for_model = lambda model: encoding
+    tiktoken.model.get_encoding = lambda name: encoding
+    return encoding
+
+
+class FakeEmbeddings(Embeddings):
+    # Bag of hashed words, close enough for retrieval over fake chunks.
+    def __init__(self, dim: int = 64) -> None:
+        self.dim = dim
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1.0
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class FakeVectorStore(InMemoryVectorStore):
+    # In-memory search plus the round trip a hosted index would add.
+    def __init__(self, embedding: Embeddings, latency: float = 0.05, namespace: Optional[str] = None) -> None:
+        super().__init__(embedding, namespace)
+        self.latency = latency
+
+    def similarity_search_with_score(self, *args: Any, **kwargs: Any):
+        time.sleep(self.latency)
+        return super().similarity_search_with_score(*args, **kwargs)
+
+
+class LocalServer:
+    # An aiohttp app serving `routes` on a free port, run from its own
+    # thread so blocking clients can use it too.
+    def __init__(self, routes: List[web.RouteDef]) -> None:
+        self.routes = routes
+        self.loop = None
+        self.runner = None
+        self.port = None
+
+    def start(self):
+        started = threading.Event()
+
+        def run() -> None:
+            self.loop = asyncio.new_event_loop()
+            app = web.Application()
+            app.add_routes(self.routes)
+            self.runner = web.AppRunner(app, access_log=None)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            self.loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class FakeOpenAIServer(LocalServer):
+    # Speaks enough of the chat completions API for ChatOpenAI, streamed
+    # and not.
+    def __init__(self, latency: float = 0.3, token_delay: float = 0.01, words: int = 40) -> None:
+        super().__init__([web.post("/v1/chat/completions", self.chat_completions)])
+        self.latency = latency
+        self.token_delay = token_delay
+        self.words = words
+        self.requests = 0
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def answer(self, body: dict) -> List[str]:
+        question = body["messages"][-1]["content"].split()
+        return [f"answer-{i}" if i >= len(question) else question[i] for i in range(self.words)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        words = self.answer(body)
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": "fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "fake"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": " ".join(words)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)},
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else f" {word}"}
+            await response.write(self.chunk(body, delta, None))
+            await asyncio.sleep(self.token_delay)
+        await response.write(self.chunk(body, {}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def chunk(self, body: dict, delta: dict, finish_reason: Optional[str]) -> bytes:
+        data = {
+            "id": "fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(data)}\n\n".encode()
+
+
+WORDS = (
+    "model data retrieval training results method baseline evaluation language neural "
+    "attention transformer dataset benchmark accuracy loss gradient embedding query "
+    "document context generation inference latency memory token layer parameter "
+    "experiment analysis performance task learning representation graph vector search"
+).split()
+
+
+def make_pdf(seed: int, pages: int = 6, lines: int = 40) -> bytes:
+    # A plain PDF whose text differs per seed, so every paper misses the
+    # extraction and summary caches.
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        text = [b"BT /F1 10 Tf 12 TL 50 750 Td"]
+        for _ in range(lines):
+            sentence = " ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + "."
+            text.append(b"(" + sentence.encode() + b") Tj T*")
+        text.append(b"ET")
+        stream = b"\n".join(text)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + b"] /Count %d >>" % pages
+
+    body = b"%PDF-1.4\n"
+    offsets = []
+    for number, content in enumerate(objects, start=1):
+        offsets.append(len(body))
+        body += b"%d 0 obj\n" % number + content + b"\nendobj\n"
+    xref = len(body)
+    body += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    body += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    body += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return body
+
+
+class FakeArxivServer(LocalServer):
+    # A "pastweek" listing of `papers` papers spread over `days` dates, with
+    # titles, authors and abstracts, and their PDFs. PDFs are generated per
+    # paper, or served from fixture files in turn when any are given. The
+    # listing honours skip and show like arXiv's, and every
+    # `withdrawn_every`th entry has no PDF link. It answers conditional GETs
+    # with a 304 unless `validators` is off, and the statuses queued in
+    # `fail_next` are returned, one per request, before any listing.
+    def __init__(
+        self,
+        pdf_files: List[str] = (),
+        papers: int = 20,
+        days: int = 2,
+        latency: float = 0.02,
+        withdrawn_every: int = 0,
+        validators: bool = True,
+    ) -> None:
+        super().__init__(
+            [
+                web.get("/list/{category}/pastweek", self.listing),
+                web.get("/pdf/{arxiv_id}", self.pdf),
+            ]
+        )
+        self.pdfs = []
+        for path in pdf_files:
+            with open(path, "rb") as fp:
+                self.pdfs.append(fp.read())
+        self.papers = papers
+        self.days = days
+        self.latency = latency
+        self.withdrawn_every = withdrawn_every
+        self.validators = validators
+        self.last_modified = formatdate(usegmt=True)
+        self.fail_next: List[int] = []
+        self.requests = 0
+        self.not_modified = 0
+
+    def arxiv_id(self, number: int) -> str:
+        return f"2310.{number + 1:05d}"
+
+    def render_listing(self, skip: int = 0, show: int | None = None) -> str:
+        parts = ["<html><body><div id='dlpage'>"]
+        per_day = -(-self.papers // self.days)
+        window = range(self.papers)[skip:None if show is None else skip + show]
+        for day in range(self.days):
+            numbers = [number for number in window if number // per_day == day]
+            if not numbers:
+                continue
+            date = (datetime.now() - timedelta(days=day)).strftime("%a, %d %b %Y")
+            parts.append(f"<h3>{date}</h3><dl>")
+            for number in numbers:
+                arxiv_id = self.arxiv_id(number)
+                pdf_link = f" [<a href='/pdf/{arxiv_id}' title='Download PDF'>pdf</a>]"
+                if self.withdrawn_every and number % self.withdrawn_every == self.withdrawn_every - 1:
+                    pdf_link = ""
+                parts.append(
+                    f"<dt><span class='list-identifier'><a href='/abs/{arxiv_id}' title='Abstract'>"
+                    f"arXiv:{arxiv_id}</a>{pdf_link}</span></dt>"
+                    f"<dd><div class='meta'><div class='list-title mathjax'><span class='descriptor'>Title:</span> "
+                    f"{escape(f'Benchmark paper {number + 1} on retrieval')}</div>"
+                    f"<div class='list-authors'><a href='/a/one'>Author One</a>, <a href='/a/two'>Author Two</a></div>"
+                    f"<p class='mathjax'>Paper {number + 1} studies retrieval augmented generation "
+                    f"over scientific text and reports results on a benchmark.</p></div></dd>"
+                )
+            parts.append("</dl>")
+        parts.append("</div></body></html>")
+        return "".join(parts)
+
+    async def listing(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.fail_next:
+            return web.Response(status=self.fail_next.pop(0), text="<html><body>Error</body></html>")
+        skip = int(request.query.get("skip", 0))
+        show = int(request.query["show"]) if "show" in request.query else None
+        body = self.render_listing(skip, show)
+        headers = {}
+        if self.validators:
+            headers = {
+                "ETag": '"' + hashlib.sha256(body.encode()).hexdigest()[:16] + '"',
+                "Last-Modified": self.last_modified,
+            }
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                self.not_modified += 1
+                return web.Response(status=304, headers=headers)
+        return web.Response(text=body, content_type="text/html", headers=headers)
+
+    async def pdf(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        number = int(request.match_info["arxiv_id"].removesuffix(".pdf").split(".")[-1]) - 1
+        body = self.pdfs[number % len(self.pdfs)] if self.pdfs else make_pdf(number)
+        return web.Response(body=body, content_type="application/pdf")
+
+
+class LocalTransport(httpx.AsyncBaseTransport):
+    # Sends every request to a local server whatever host it names, so the
+    # scraper's hard-coded arxiv.org links reach FakeArxivServer.
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self.port)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", kwargs: dict) -> None:
+        self.channel = channel
+        self.kwargs = kwargs
+        self.edits = 0
+
+    async def edit(self, **kwargs: Any) -> "FakeMessage":
+        await asyncio.sleep(self.channel.latency)
+        self.kwargs.update(kwargs)
+        self.edits += 1
+        return self
+
+
+class FakeChannel:
+    # Stands in for a discord.TextChannel, sends take a fixed API latency
+    # and are recorded with the time they arrived.
+    def __init__(self, latency: float = 0.05, channel_id: int = 1, name: str = "general") -> None:
+        self.latency = latency
+        self.id = channel_id
+        self.name = name
+        self.sent: List[tuple] = []
+
+    async def send(self, **kwargs: Any) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, kwargs)
+        self.sent.append((time.perf_counter(), message))
+        return message
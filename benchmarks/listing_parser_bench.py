@@ -0,0 +1,92 @@
+"""Checks the streaming listing parser against parse_page, then times both."""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from arxiv_scraper import ArxivScraper, ListingParser
+from benchmarks.fakes import FakeArxivServer
+
+DEFAULT_FIXTURES = [os.path.join(os.path.dirname(__file__), "fixtures", "pastweek.html")]
+CHUNK_SIZES = [1, 97, 4096, 65536]
+
+
+def full_tree(page: bytes) -> tuple:
+    scraper = ArxivScraper(None, 1, "selectors.json")
+    links, titles = scraper.parse_page(page)
+    return links, titles, scraper.details
+
+
+def streaming(page: bytes, chunk_size: int, on_record=None) -> tuple:
+    parser = ListingParser()
+    titles = {}
+    for start in range(0, len(page), chunk_size):
+        for record in parser.feed(page[start:start + chunk_size]):
+            if on_record is not None:
+                on_record()
+            titles[record[1]] = record[2]
+    for record in parser.close():
+        titles[record[1]] = record[2]
+    return parser.links, titles, parser.details
+
+
+def check(path: str) -> bool:
+    with open(path, "rb") as fp:
+        page = fp.read()
+    expected = full_tree(page)
+    ok = True
+    for chunk_size in CHUNK_SIZES:
+        result = streaming(page, chunk_size)
+        for name, old, new in zip(("links", "titles", "details"), expected, result):
+            if old != new:
+                ok = False
+                print(f"MISMATCH {path} chunk={chunk_size} {name}:")
+                print(f"  parse_page    {old}")
+                print(f"  ListingParser {new}")
+    links, titles, _ = expected
+    print(
+        f"{'ok' if ok else 'FAILED':<6} {path}: {len(links)} dates, "
+        f"{sum(len(date_links) for date_links in links.values())} links, {len(titles)} titles"
+    )
+    return ok
+
+
+def measure(mode: str, entries: int, chunk_size: int) -> tuple:
+    page = FakeArxivServer(papers=entries, days=5).render_listing().encode()
+    # ru_maxrss is in kilobytes on Linux.
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    first = []
+    start = time.perf_counter()
+    if mode == "full-tree":
+        # parse_page only returns once the whole tree is built and scanned.
+        full_tree(page)
+        first.append(time.perf_counter() - start)
+    else:
+        streaming(page, chunk_size, lambda: first or first.append(time.perf_counter() - start))
+    elapsed = time.perf_counter() - start
+    return elapsed, first[0] if first else 0.0, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixture", nargs="+", default=DEFAULT_FIXTURES)
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    ok = all([check(path) for path in args.fixture])
+
+    print(f"generated listing of {args.entries} entries")
+    for mode in ("full-tree", "streaming"):
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            elapsed, first, rss = pool.apply(measure, (mode, args.entries, args.chunk_size))
+        print(f"{mode:<10} total {elapsed * 1000:8.1f}ms  first paper {first * 1000:8.1f}ms  +{rss:6.1f}MB RSS")
+
+    if not ok:
+        sys.exit("the streaming parser does not match parse_page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Pages per second for PDF extraction and chunking."""
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+from langchain.document_loaders import PyPDFLoader
+from langchain.text_splitter import CharacterTextSplitter
+from pypdf import PdfReader
+
+from benchmarks.fakes import make_pdf, offline_tiktoken
+from pdf_extraction import PDFExtractor
+
+
+def serial_load(filepath: str) -> list:
+    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(chunk_size=1000, chunk_overlap=0)
+    return PyPDFLoader(filepath).load_and_split(text_splitter=text_splitter)
+
+
+def run(name: str, load, files: list, pages: int) -> None:
+    start = time.perf_counter()
+    chunks = sum(len(load(filepath)) for filepath in files)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} {pages / elapsed:9.1f} pages/s  {elapsed:7.2f}s  {chunks} chunks")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdfs", default="")
+    parser.add_argument("--papers", type=int, default=12)
+    parser.add_argument("--pages", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--real-tokenizer", action="store_true")
+    args = parser.parse_args()
+    if not args.real_tokenizer:
+        offline_tiktoken()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        pdf_dir = args.pdfs
+        if not pdf_dir:
+            pdf_dir = os.path.join(cache_dir, "pdfs")
+            os.makedirs(pdf_dir)
+            for seed in range(args.papers):
+                with open(os.path.join(pdf_dir, f"paper-{seed}.pdf"), "wb") as fp:
+                    fp.write(make_pdf(seed, pages=args.pages))
+        files = sorted(glob.glob(os.path.join(pdf_dir, "*.pdf")))
+        if not files:
+            raise SystemExit(f"No PDFs in {pdf_dir}")
+
+        extractor = PDFExtractor(os.path.join(cache_dir, "text"), workers=args.workers)
+        # Start every worker outside the timings, the pool spawns them on demand.
+        list(extractor.get_pool().map(time.sleep, [0.5] * args.workers))
+
+        pages = sum(len(PdfReader(filepath).pages) for filepath in files)
+        print(f"{len(files)} PDFs, {pages} pages, {args.workers} workers")
+        run("serial", serial_load, files, pages)
+        run("cold", extractor.load, files, pages)
+        run("warm", extractor.load, files, pages)
+        run("rechunk", lambda filepath: extractor.load(filepath, chunk_size=500), files, pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Retrieval quality and latency of dense, BM25 and hybrid retrieval."""
+import argparse
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+from langchain.text_splitter import CharacterTextSplitter
+from pypdf import PdfReader
+
+from benchmarks.fakes import FakeEmbeddings
+from hybrid_retrieval import CrossEncoderReranker, HybridRetriever, KeywordIndex
+from vector_stores import InMemoryVectorStore
+
+DEFAULT_PDFS = [
+    "/usr/share/doc/libtasn1-doc/libtasn1.pdf",
+    "/usr/share/doc/shared-mime-info/shared-mime-info-spec.pdf",
+]
+NAMESPACE = "bench.pdf"
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def load_chunks(paths: list) -> list:
+    splitter = CharacterTextSplitter(separator="\n", chunk_size=800, chunk_overlap=0)
+    chunks = []
+    for path in paths:
+        for page in PdfReader(path).pages:
+            chunks.extend(chunk for chunk in splitter.split_text(page.extract_text()) if len(chunk) > 200)
+    return list(dict.fromkeys(chunks))
+
+
+def make_queries(rng, chunks: list, count: int) -> list:
+    words = [re.findall(r"[a-z][a-z0-9_]{4,}", chunk.lower()) for chunk in chunks]
+    document_frequency = Counter(word for chunk_words in words for word in set(chunk_words))
+    queries = []
+    for index in rng.sample(range(len(chunks)), min(count, len(chunks))):
+        rare = sorted(set(words[index]), key=lambda word: (document_frequency[word], word))[:2]
+        if len(rare) == 2:
+            queries.append(("terms", f"What does the paper say about {rare[0]} and {rare[1]}?", index))
+        tokens = chunks[index].split()
+        start = rng.randrange(max(1, len(tokens) - 20))
+        window = [token for token in tokens[start:start + 20] if rng.random() > 0.3]
+        rng.shuffle(window)
+        queries.append(("paraphrase", " ".join(window), index))
+    return queries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf", nargs="+", default=DEFAULT_PDFS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--rrf-k", type=int, default=HybridRetriever.__fields__["rrf_k"].default)
+    parser.add_argument("--dense-weight", type=float, default=HybridRetriever.__fields__["dense_weight"].default)
+    parser.add_argument("--rerank-model", default="")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    chunks = load_chunks(args.pdf)
+    queries = make_queries(rng, chunks, args.queries)
+    print(f"{len(chunks)} chunks, {len(queries)} queries")
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = InMemoryVectorStore(FakeEmbeddings(args.dim)).scoped(NAMESPACE)
+        store.add_texts(chunks, metadatas=[{"chunk": i} for i in range(len(chunks))])
+        keyword_index = KeywordIndex(os.path.join(directory, "keywords.db"))
+        start = time.perf_counter()
+        keyword_index.add(
+            NAMESPACE, [f"chunk-{i}" for i in range(len(chunks))], chunks, [{"chunk": i} for i in range(len(chunks))]
+        )
+        print(f"keyword index built in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        hybrid = HybridRetriever(
+            vectorstore=store,
+            keyword_index=keyword_index,
+            namespace=NAMESPACE,
+            k=args.k,
+            fetch_k=args.fetch_k,
+            rrf_k=args.rrf_k,
+            dense_weight=args.dense_weight,
+        )
+        methods = {
+            "dense": lambda query: store.similarity_search(query, k=args.k),
+            "bm25": lambda query: [
+                document for document, _ in keyword_index.search(NAMESPACE, query, args.k)
+            ],
+            "hybrid": hybrid.retrieve,
+            "hybrid-rrf60": hybrid.copy(update={"rrf_k": 60, "dense_weight": 1.0}).retrieve,
+        }
+        if args.rerank_model:
+            reranked = hybrid.copy(update={"reranker": CrossEncoderReranker(args.rerank_model)})
+            methods["hybrid+rerank"] = reranked.retrieve
+
+        for name, retrieve in methods.items():
+            hits, reciprocal_ranks, latencies = Counter(), Counter(), []
+            for kind, query, index in queries:
+                start = time.perf_counter()
+                documents = retrieve(query)
+                latencies.append(time.perf_counter() - start)
+                ranks = [rank for rank, document in enumerate(documents) if document.page_content == chunks[index]]
+                if ranks:
+                    hits[kind] += 1
+                    reciprocal_ranks[kind] += 1.0 / (ranks[0] + 1)
+            kinds = Counter(kind for kind, _, _ in queries)
+            quality = "  ".join(
+                f"{kind} recall@{args.k}={hits[kind] / kinds[kind]:.2f} mrr={reciprocal_ranks[kind] / kinds[kind]:.2f}"
+                for kind in sorted(kinds)
+            )
+            print(
+                f"{name:<14} {quality}  p50={statistics.median(latencies) * 1000:6.2f}ms "
+                f"p99={percentile(latencies, 0.99) * 1000:6.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
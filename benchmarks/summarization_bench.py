@@ -0,0 +1,52 @@
+"""Wall-clock time and token use of summarize_pdf with a fake LLM."""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from langchain.chains.summarize import load_summarize_chain
+from langchain.docstore.document import Document
+from peewee import SqliteDatabase
+
+from benchmarks.fakes import FakeLLM
+from summarization import SummaryEngine
+
+WORDS = "model data training retrieval attention layer loss benchmark dataset token".split()
+
+
+def make_docs(count: int, words: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [
+        Document(page_content=" ".join(rng.choice(WORDS) for _ in range(words)), metadata={"page": i})
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=40)
+    parser.add_argument("--words", type=int, default=700)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    llm = FakeLLM(latency=args.latency)
+    docs = make_docs(args.chunks, args.words)
+
+    start = time.perf_counter()
+    load_summarize_chain(llm, chain_type="map_reduce").run(docs)
+    print(f"{'chain':<16} {time.perf_counter() - start:7.2f}s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = SqliteDatabase(os.path.join(directory, "bench.db"))
+        engine = SummaryEngine(llm, db, max_concurrency=args.concurrency)
+        edited = docs[:-3] + make_docs(3, args.words, seed=1)
+        for name, run_docs in (("engine cold", docs), ("engine repeat", docs), ("engine 3 edited", edited)):
+            _, stats = engine.summarize_with_stats(run_docs)
+            print(f"{name:<16} {stats.wall_time:7.2f}s  {stats.describe()}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Recall@10 and query latency of the local ANN index."""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from vector_stores import ANNIndex
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def make_corpus(rng, count: int, dim: int, clusters: int, noise: float = 0.5) -> np.ndarray:
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, count)] + noise * rng.normal(size=(count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=5_000)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_corpus(rng, args.vectors, args.dim, args.clusters, args.noise)
+    queries = vectors[rng.integers(0, args.vectors, args.queries)]
+    queries = queries + 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = ANNIndex(directory, nprobe=args.nprobe)
+        start = time.perf_counter()
+        for offset in range(0, args.vectors, args.batch):
+            rows = range(offset, min(offset + args.batch, args.vectors))
+            index.add(
+                [f"doc-{i}" for i in rows],
+                vectors[offset:offset + len(rows)],
+                [f"chunk {i}" for i in rows],
+                [{"category": f"cat-{i % 8}"} for i in rows],
+            )
+        print(f"incremental add of {args.vectors} vectors: {time.perf_counter() - start:.2f}s "
+              f"({len(index.centroids)} lists)")
+
+        # Ground truth first, an exact scan between ANN queries would evict
+        # the probed lists from the CPU cache and time that instead.
+        exact_samples, exact_results = [], []
+        for query in queries:
+            start = time.perf_counter()
+            exact_results.append(set(np.argpartition(-(vectors @ query), 10)[:10]))
+            exact_samples.append(time.perf_counter() - start)
+
+        ann_samples, recalls = [], []
+        for query, exact in zip(queries, exact_results):
+            start = time.perf_counter()
+            found = index.search(query, 10)
+            ann_samples.append(time.perf_counter() - start)
+            recalls.append(len(exact & {row for row, _ in found}) / 10)
+
+        filtered_samples = []
+        for query in queries[:100]:
+            start = time.perf_counter()
+            index.search(query, 10, {"category": "cat-3"})
+            filtered_samples.append(time.perf_counter() - start)
+
+    for name, samples in (
+        ("exact scan", exact_samples),
+        ("ann", ann_samples),
+        ("ann with metadata filter", filtered_samples),
+    ):
+        print(
+            f"{name:<26} p50={statistics.median(samples) * 1000:7.3f}ms "
+            f"p99={percentile(samples, 0.99) * 1000:7.3f}ms"
+        )
+    recall = statistics.mean(recalls)
+    print(f"recall@10={recall:.3f}")
+    if recall < args.min_recall:
+        sys.exit(f"recall@10 below {args.min_recall}")
+
+
+if __name__ == "__main__":
+    main()
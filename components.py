@@ -1,39 +1,167 @@
 import discord
-from openai_utils import add_pdf_to_memory, summarize_pdf
-from globals import database_manager, channel_name
-from utils import create_pdf_embed, embeded_text
+import os
+from collections import OrderedDict
+from downloader import DownloadError
+from ingestion import IngestionJob, ingestion_queue
+from message_scheduler import NOTICE, message_scheduler
+from openai_utils import pdf_metadata
+from utils import create_pdf_embed, download_pdf, embeded_text
 
 
-class NewPDF(discord.ui.View): 
-    def __init__(self, *, timeout: float | None = None, pdf_url: str, pdf_file_path: str, title: str, bot):
-        super().__init__(timeout=timeout)
-        button = discord.ui.Button(label="Read PDF", style=discord.ButtonStyle.gray, emoji="📃", url=pdf_url)
-        self.add_item(button)
-        self.pdf_file_path = pdf_file_path
-        self.bot = bot
+class PaperIngestion:
+    def __init__(self, pdf_url: str, pdf_file_path: str, title: str, category: str = "", authors: list[str] | None = None):
         self.pdf_url = pdf_url
+        self.pdf_file_path = pdf_file_path
         self.title = title
-        
-        
-    @discord.ui.button(label="Add To Pinecone", style=discord.ButtonStyle.green, emoji="🌲") 
-    async def add_pinecone(self, interaction: discord.Interaction, button):
-        channel = discord.utils.get(self.bot.get_all_channels(), name=channel_name)
-        await channel.send(embed=embeded_text(f"Adding {self.title} to pinecone..", "Information")) 
-        
-        button.disabled = True 
-        button.label = "Adding to Pinecone" 
-        await interaction.response.edit_message(view=self) 
-        
-        
-        namespace, pages = add_pdf_to_memory(self.pdf_file_path)
-        database_manager.create_pdf_file(
-            namespace, self.pdf_file_path, self.pdf_file_path.split("__")[2][:-4]
+        self.category = category
+        self.authors = authors or []
+
+    async def submit(self) -> bool:
+        await message_scheduler.send(
+            embed=embeded_text(f"Adding {self.title} to pinecone..", "Information"),
+            priority=NOTICE,
+        )
+
+        # New papers are announced from their abstract, the PDF is only
+        # fetched here, the first time somebody asks for the full text.
+        if not os.path.exists(self.pdf_file_path):
+            try:
+                await download_pdf(self.pdf_url, self.pdf_file_path)
+            except DownloadError as e:
+                message_scheduler.post(
+                    embed=embeded_text(f"Could not download {self.title}: {e}", "Error")
+                )
+                return False
+
+        metadata = pdf_metadata(self.pdf_file_path, self.pdf_url, self.category)
+        if self.authors:
+            metadata["authors"] = self.authors
+        job = await ingestion_queue.submit(
+            self.pdf_file_path,
+            self.pdf_url,
+            self.pdf_file_path.split("__")[2][:-4],
+            on_done=self.notify_done,
+            metadata=metadata,
+        )
+        message_scheduler.post(
+            embed=embeded_text(f"Queued as job #{job.job_id}", "Information"), priority=NOTICE
         )
+        return True
+
+    async def notify_done(self, job: IngestionJob):
+        if job.status == "failed":
+            message_scheduler.post(
+                embed=embeded_text(f"Could not add {self.title}: {job.error}", "Error"),
+                priority=NOTICE,
+            )
+            return
         embed = create_pdf_embed(
-            summary=summarize_pdf(pages), link=self.pdf_url, title=self.title
+            summary=job.summary, link=self.pdf_url, title=self.title
         )
-        
-        await channel.send(embed=embed) 
+        message_scheduler.post(embed=embed, priority=NOTICE)
+
+
+class PaperDigestView(discord.ui.View):
+    # One message carries up to 10 papers, so each paper gets a numbered
+    # "Add" button next to its "Read" link, two rows of five per kind.
+    def __init__(self, *, papers: list[dict], timeout: float | None = None):
+        super().__init__(timeout=timeout)
+        for number, paper in enumerate(papers, start=1):
+            ingestion = PaperIngestion(
+                paper["link"], paper["file_path"], paper["title"], paper.get("category", ""), paper.get("authors")
+            )
+            button = discord.ui.Button(
+                label=f"Add {number}", style=discord.ButtonStyle.green, emoji="🌲", row=(number - 1) // 5
+            )
+            button.callback = self.make_callback(button, ingestion)
+            self.add_item(button)
+        for number, paper in enumerate(papers, start=1):
+            self.add_item(
+                discord.ui.Button(label=f"Read {number}", style=discord.ButtonStyle.gray, url=paper["link"], row=2 + (number - 1) // 5)
+            )
 
+    def make_callback(self, button: discord.ui.Button, ingestion: PaperIngestion):
+        async def callback(interaction: discord.Interaction):
+            button.disabled = True
+            await interaction.response.edit_message(view=self)
+            if not await ingestion.submit():
+                button.disabled = False
+                await interaction.message.edit(view=self)
+
+        return callback
+
+
+class PDFListPages:
+    def __init__(self, pdf_manager, page_size: int = 10, max_pages: int = 64) -> None:
+        self.pdf_manager = pdf_manager
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.version = pdf_manager.version
+        self.pages = OrderedDict()
+        self.total = None
+
+    def invalidate_if_changed(self) -> None:
+        if self.version != self.pdf_manager.version:
+            self.version = self.pdf_manager.version
+            self.pages.clear()
+            self.total = None
+
+    def render(self, after_id: int, page_number: int) -> tuple[discord.Embed, int, bool]:
+        self.invalidate_if_changed()
+        if after_id not in self.pages:
+            pdfs = self.pdf_manager.get_pdfs_page(after_id, self.page_size + 1)
+            has_more = len(pdfs) > self.page_size
+            pdfs = pdfs[: self.page_size]
+            self.pages[after_id] = (
+                [self.field_name(pdf) for pdf in pdfs],
+                pdfs[-1].id if pdfs else after_id,
+                has_more,
+            )
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        if self.total is None:
+            self.total = self.pdf_manager.count_pdfs()
+
+        self.pages.move_to_end(after_id)
+        names, last_id, has_more = self.pages[after_id]
+        embed = discord.Embed(title="Available PDFs")
+        for name in names:
+            embed.add_field(name=name, value="\u200b", inline=False)
+        pages = max(1, -(-self.total // self.page_size))
+        embed.set_footer(text=f"Page {page_number} of {pages} · !choose <id> or !choose <title>")
+        return embed, last_id, has_more
+
+    def field_name(self, pdf) -> str:
+        try:
+            return f"{pdf.id}. {pdf.pdf_title} ({pdf.pdf_name.split('__')[1]})"
+        except Exception:
+            return f"{pdf.id}. {pdf.pdf_title}"
+
+
+class PDFListView(discord.ui.View):
+    def __init__(self, *, pages: PDFListPages, timeout: float | None = 300):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.cursors = [0]
+        self.last_id = 0
+        self.has_more = False
+
+    def render(self) -> discord.Embed:
+        embed, self.last_id, self.has_more = self.pages.render(
+            self.cursors[-1], len(self.cursors)
+        )
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = not self.has_more
+        return embed
 
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.gray, emoji="⬅️")
+    async def previous_page(self, interaction: discord.Interaction, button):
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        await interaction.response.edit_message(embed=self.render(), view=self)
 
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.gray, emoji="➡️")
+    async def next_page(self, interaction: discord.Interaction, button):
+        if self.has_more:
+            self.cursors.append(self.last_id)
+        await interaction.response.edit_message(embed=self.render(), view=self)
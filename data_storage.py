@@ -1,6 +1,15 @@
 import contextlib
+from typing import Iterable
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+    "mmap_size": 256 * 1024 * 1024,
+}
 
 
 class PDFFileManager:
@@ -13,14 +22,31 @@ class PDFFileManager:
             class Meta:
                 database = db
                 
+        self.db = db
         self.model = PDFFile
+        self.version = 0
         db.connect(reuse_if_open=True)
         db.create_tables([PDFFile], safe=True)
+        db.execute_sql(
+            f'CREATE INDEX IF NOT EXISTS "{PDFFile._meta.table_name}_title_nocase" '
+            f'ON "{PDFFile._meta.table_name}" (pdf_title COLLATE NOCASE)'
+        )
 
     def create_pdf_file(self, namespace: str, pdf_name: str, pdf_title: str):
         with contextlib.suppress(Exception):
             pdf_file = self.model(namespace=namespace, pdf_name=pdf_name, pdf_title=pdf_title)
             pdf_file.save(force_insert=True)
+            self.version += 1
+
+    def create_pdf_files(self, pdf_files: Iterable[tuple[str, str, str]]) -> None:
+        rows = [
+            {"namespace": namespace, "pdf_name": pdf_name, "pdf_title": pdf_title}
+            for namespace, pdf_name, pdf_title in pdf_files
+        ]
+        with self.db.atomic():
+            for batch in chunked(rows, 100):
+                self.model.insert_many(batch).on_conflict_ignore().execute()
+        self.version += 1
 
     def read_pdf_file(self, pdf_name: str):
         try:
@@ -32,19 +58,54 @@ class PDFFileManager:
         pdf_file = self.model.get(self.model.pdf_name == pdf_name)
         pdf_file.pdf_title = pdf_title
         pdf_file.save()
+        self.version += 1
 
     def delete_pdf_file(self, pdf_name: str):
         pdf_file = self.model.get(self.model.pdf_name == pdf_name)
         pdf_file.delete_instance()
+        self.version += 1
         
     def get_all_pdfs(self) -> list:
         return list(self.model.select())
 
+    def get_pdfs_page(self, after_id: int = 0, limit: int = 10) -> list:
+        query = self.model.select().where(self.model.id > after_id).order_by(self.model.id).limit(limit)
+        return list(query)
+
+    def count_pdfs(self) -> int:
+        return self.model.select().count()
+
     def get_pdf_by_name(self, pdf_name: str):
         try:
             return self.model.get(self.model.pdf_name == pdf_name)
         except DoesNotExist:
             return None
+
+    def get_pdf_by_id(self, pdf_id: int):
+        return self.model.get_or_none(self.model.id == pdf_id)
+
+    def search_pdfs(self, term: str, limit: int = 10) -> list:
+        # Titles are stored as slugs with spaces turned into "-" (see
+        # clean_title in arxiv_scraper), so the term is slugged the same way.
+        # A range scan over the NOCASE title index serves prefixes, LIKE
+        # cannot use an index on a default-collation column.
+        prefix = term.strip().replace(" ", "-")
+        title = self.model.pdf_title.collate("NOCASE")
+        query = self.model.select().where(
+            (title >= prefix) & (title < prefix + "\uffff")
+        ).order_by(title).limit(limit)
+        pdfs = list(query)
+        words = [word for word in prefix.split("-") if word]
+        if len(pdfs) >= limit or not words:
+            return pdfs
+
+        # Then titles with every word of the term anywhere in them, which
+        # takes a scan, so "attention" also finds "Efficient-Attention-...".
+        condition = self.model.id.not_in([pdf.id for pdf in pdfs])
+        for word in words:
+            condition &= self.model.pdf_title.contains(word)
+        query = self.model.select().where(condition).order_by(title).limit(limit - len(pdfs))
+        return pdfs + list(query)
     
 
 class ChatManager:
@@ -55,27 +116,145 @@ class ChatManager:
             human_message = TextField()
             sequence_number = IntegerField()
             namespace = CharField()
+            session = CharField(default="")
 
             class Meta:
                 database = db
+                indexes = ((("namespace", "session", "sequence_number"), False),)
+
+        class ChatSummary(Model):
+            namespace = CharField()
+            session = CharField(default="")
+            summary = TextField()
+            last_sequence_number = IntegerField()
+
+            class Meta:
+                database = db
+                indexes = ((("namespace", "session"), True),)
                 
+        self.db = db
         self.model = ChatMessage
+        self.summary_model = ChatSummary
         db.connect(reuse_if_open=True)
-        db.create_tables([ChatMessage], safe=True)
+        if db.table_exists(ChatMessage._meta.table_name):
+            self.migrate_session_column(db)
+        db.create_tables([ChatMessage, ChatSummary], safe=True)
+
+    def migrate_session_column(self, db: SqliteDatabase) -> None:
+        columns = {column.name for column in db.get_columns(self.model._meta.table_name)}
+        if "session" not in columns:
+            migrator = SqliteMigrator(db)
+            migrate(migrator.add_column(self.model._meta.table_name, "session", self.model.session))
         
-    def add_message(self, namespace: str, ai_message: str, human_message: str) -> None:
-        last_message = self.model.select().where(self.model.namespace == namespace).order_by(
-            self.model.sequence_number.desc()).first()
+    def next_sequence_number(self, namespace: str, session: str) -> int:
+        last = self.model.select(fn.MAX(self.model.sequence_number)).where(
+            (self.model.namespace == namespace) & (self.model.session == session)
+        ).scalar()
+        return 0 if last is None else last + 1
 
-        if last_message is None:
-            sequence_number = 0
-        else:
-            sequence_number = last_message.sequence_number + 1
+    def add_message(self, namespace: str, ai_message: str, human_message: str, session: str = "") -> int:
+        # IMMEDIATE takes the write lock before reading the last sequence
+        # number, so concurrent writers cannot allocate the same one.
+        with self.db.atomic(lock_type="IMMEDIATE"):
+            sequence_number = self.next_sequence_number(namespace, session)
+            self.model.create(namespace=namespace, ai_message=ai_message, human_message=human_message,
+                                sequence_number=sequence_number, session=session)
+        return sequence_number
 
-        self.model.create(namespace=namespace, ai_message=ai_message, human_message=human_message,
-                            sequence_number=sequence_number)
+    def add_messages(
+        self, namespace: str, messages: Iterable[tuple[str, str]], session: str = ""
+    ) -> None:
+        with self.db.atomic(lock_type="IMMEDIATE"):
+            sequence_number = self.next_sequence_number(namespace, session)
+            rows = [
+                {
+                    "namespace": namespace,
+                    "session": session,
+                    "ai_message": ai_message,
+                    "human_message": human_message,
+                    "sequence_number": sequence_number + offset,
+                }
+                for offset, (ai_message, human_message) in enumerate(messages)
+            ]
+            for batch in chunked(rows, 100):
+                self.model.insert_many(batch).execute()
 
-    def retrieve_all_messages(self, namespace: str):
-        query = self.model.select().where(self.model.namespace == namespace).order_by(self.model.sequence_number)
+    def retrieve_all_messages(self, namespace: str, session: str = ""):
+        query = self.model.select().where(
+            (self.model.namespace == namespace) & (self.model.session == session)
+        ).order_by(self.model.sequence_number)
         return [(row.human_message, row.ai_message) for row in query]
-    
\ No newline at end of file
+
+    def retrieve_recent_messages(
+        self, namespace: str, session: str = "", limit: int = 10, after_sequence_number: int = -1
+    ) -> list:
+        query = self.model.select().where(
+            (self.model.namespace == namespace)
+            & (self.model.session == session)
+            & (self.model.sequence_number > after_sequence_number)
+        ).order_by(self.model.sequence_number.desc()).limit(limit)
+        return [(row.sequence_number, row.human_message, row.ai_message) for row in reversed(list(query))]
+
+    def get_summary(self, namespace: str, session: str = "") -> tuple[str, int]:
+        row = self.summary_model.get_or_none(
+            (self.summary_model.namespace == namespace) & (self.summary_model.session == session)
+        )
+        if row is None:
+            return "", -1
+        return row.summary, row.last_sequence_number
+
+    def save_summary(self, namespace: str, summary: str, last_sequence_number: int, session: str = "") -> None:
+        self.summary_model.insert(
+            namespace=namespace,
+            session=session,
+            summary=summary,
+            last_sequence_number=last_sequence_number,
+        ).on_conflict(
+            conflict_target=[self.summary_model.namespace, self.summary_model.session],
+            update={
+                self.summary_model.summary: summary,
+                self.summary_model.last_sequence_number: last_sequence_number,
+            },
+        ).execute()
+
+
+class PaperManager:
+    def __init__(self, db: SqliteDatabase) -> None:
+        class Paper(Model):
+            arxiv_id = CharField(primary_key=True)
+            link = CharField()
+            file_path = CharField()
+            title = CharField()
+            category = CharField(default="")
+            authors = TextField(default="")
+            abstract = TextField(default="")
+            summary = TextField(default="")
+
+            class Meta:
+                database = db
+
+        self.db = db
+        self.model = Paper
+        db.connect(reuse_if_open=True)
+        db.create_tables([Paper], safe=True)
+
+    def save_paper(self, paper: dict) -> None:
+        # Authors are stored one per line.
+        fields = {
+            "link": paper["link"],
+            "file_path": paper["file_path"],
+            "title": paper["title"],
+            "category": paper.get("category", ""),
+            "authors": "\n".join(paper.get("authors", [])),
+            "abstract": paper.get("abstract", ""),
+        }
+        self.model.insert(arxiv_id=paper["arxiv_id"], **fields).on_conflict(
+            conflict_target=[self.model.arxiv_id],
+            update={getattr(self.model, name): value for name, value in fields.items()},
+        ).execute()
+
+    def get_paper(self, arxiv_id: str):
+        return self.model.get_or_none(self.model.arxiv_id == arxiv_id)
+
+    def set_summary(self, arxiv_id: str, summary: str) -> None:
+        self.model.update(summary=summary).where(self.model.arxiv_id == arxiv_id).execute()
@@ -1,21 +1,33 @@
 import asyncio
 import os
 import discord
-from openai_utils import add_pdf_to_memory, summarize_pdf, ChatRetrievalWithDB
+from openai_utils import (
+    ChatSessionManager,
+    CorpusRetrieval,
+    answer_cache,
+    get_corpus_store,
+    parse_corpus_filter,
+    summarize_abstract,
+)
 from discord.ext import commands
 from arxiv_scraper import ArxivScraper
 from globals import (
-    channel_name,
     database_manager,
     monitor_interval,
     creds,
     chat_manager,
     config,
+    listing_cache,
+    history_store,
+    paper_manager,
 )
-from langchain.embeddings import HuggingFaceEmbeddings
+from embeddings import get_embeddings
 from langchain.chat_models import ChatOpenAI
-from components import NewPDF
-from utils import download_pdf, create_pdf_embed, embeded_text
+from components import PaperDigestView, PDFListPages, PDFListView
+from ingestion import IngestionJob, ingestion_queue
+from message_scheduler import NOTICE, StreamedReply, message_scheduler
+from metrics import llm_usage, metrics
+from utils import create_pdf_embed, embeded_text
 import asyncio
 
 
@@ -24,6 +36,45 @@ intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 bot.heartbeat_timeout = 900
 started = False
+pdf_list_pages = PDFListPages(database_manager)
+chat_sessions = None
+corpus_retrieval = None
+# The PDF each user picked with !choose, per channel like their chat session.
+chosen_pdfs = {}
+
+
+def session_key(ctx) -> str:
+    return f"{ctx.channel.id}:{ctx.author.id}"
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    message_scheduler.invalidate_channel()
+
+
+@bot.event
+async def on_guild_channel_create(channel):
+    message_scheduler.invalidate_channel()
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    message_scheduler.invalidate_channel()
+
+
+@bot.event
+async def on_guild_update(before, after):
+    message_scheduler.invalidate_channel()
+
+
+@bot.event
+async def on_guild_remove(guild):
+    message_scheduler.invalidate_channel()
+
+
+@bot.event
+async def on_guild_join(guild):
+    message_scheduler.invalidate_channel()
 
 
 
@@ -31,33 +82,66 @@ started = False
 
 
 
+async def summarize_paper(pdf: dict) -> str:
+    # One short call on the abstract instead of a map-reduce over the whole
+    # paper, full-text ingestion waits for a click.
+    loop = asyncio.get_running_loop()
+    try:
+        with metrics.span("summarize_abstract"):
+            summary = await loop.run_in_executor(
+                None, summarize_abstract, pdf["title"], pdf["abstract"]
+            )
+        paper_manager.set_summary(pdf["arxiv_id"], summary)
+        return summary
+    except Exception as e:
+        print(f"Error summarizing {pdf['link']}. Details {e}")
+        return pdf["abstract"]
+
+
 async def check_for_pdfs():
     while True:
         try:
-            print("Checking for pdfs")
-            scraper = ArxivScraper("history_file.txt", 2, "selectors.json")
-            channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
-            new_pdfs = await scraper.start(days_limit=2, pdf_limit=5)
-            print("Scrape done")
-            await asyncio.sleep(5)
-
-            print(f"New PDFS {len(new_pdfs)}")
-            
+            scraper = ArxivScraper(
+                history_store,
+                2,
+                "selectors.json",
+                page_size=250,
+                listing_cache=listing_cache,
+            )
+
+            new_pdfs = await scraper.discover(days_limit=2, pdf_limit=5)
+
             if len(new_pdfs) <= 0:
+                await asyncio.sleep(monitor_interval)
                 continue
 
-            await channel.send(
-                embed=embeded_text(f"{len(new_pdfs)} new PDFs Found!", "Information")
+            message_scheduler.post(
+                embed=embeded_text(f"{len(new_pdfs)} new PDFs Found!", "Information"),
+                priority=NOTICE,
             )
             for pdf in new_pdfs:
-                await channel.send(
-                    embed=embeded_text(pdf["title"], ":star: New Item!"),
-                    view=NewPDF(pdf_url=pdf["link"], pdf_file_path=pdf["file_path"], title=pdf["title"], bot=bot),
+                paper_manager.save_paper(pdf)
+            # All summaries are ready before the first paper is posted, so the
+            # digest's linger timer cannot split the batch one paper a message.
+            summaries = await asyncio.gather(*(summarize_paper(pdf) for pdf in new_pdfs))
+            for pdf, summary in zip(new_pdfs, summaries):
+                message_scheduler.post_digest(
+                    create_pdf_embed(
+                        summary=summary or pdf["title"],
+                        link=pdf["link"],
+                        title=pdf["title"],
+                        authors=pdf["authors"],
+                    ),
+                    pdf,
                 )
+            message_scheduler.flush_digest()
             await asyncio.sleep(monitor_interval)
                 
         except Exception as e:
+            # arXiv errors raise instead of parsing as an empty listing, wait
+            # before polling again.
             print(e)
+            await asyncio.sleep(monitor_interval)
 
 
 @bot.event
@@ -66,80 +150,143 @@ async def on_ready():
     print(
         f"{bot.user.name} has connected to Discord! Type !commands for the commands list"
     )
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
-    
-    if not started:
-        await channel.send(
-            embed=embeded_text(
-                "ChatArxiv bot has entered the chat! Type !commands for the commands list",
-                "",
-            )
-        )
-        started = True
+    # Delivers anything posted while the channel could not be found.
+    message_scheduler.invalidate_channel()
+    # on_ready fires again on every reconnect, the greeting, the metrics
+    # server and the poller only start once.
+    if started:
+        return
+    started = True
+    message_scheduler.post(
+        embed=embeded_text(
+            "ChatArxiv bot has entered the chat! Type !commands for the commands list",
+            "",
+        ),
+        priority=NOTICE,
+    )
+    if config.get("METRICS_PORT"):
+        await metrics.start_server(config.get("METRICS_HOST", "127.0.0.1"), config["METRICS_PORT"])
 
-    #await check_for_pdfs()
+    ingestion_queue.start()
     bot.loop.create_task(check_for_pdfs())
 
 
 @bot.command(name="choose")
-async def choose(ctx, message):
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
-    pdfs = database_manager.get_all_pdfs()
-    global chosen_pdf_name
-    try:
-        index = int(message)
-        chosen_pdf = pdfs[index - 1]
-        chosen_pdf_name = str(chosen_pdf.pdf_name)
-        await channel.send(
+async def choose(ctx, *message):
+    term = " ".join(message)
+    if term.isdigit():
+        pdfs = [pdf for pdf in [database_manager.get_pdf_by_id(int(term))] if pdf]
+    else:
+        pdfs = database_manager.search_pdfs(term) if term else []
+
+    if len(pdfs) == 1:
+        chosen_pdf = pdfs[0]
+        chosen_pdfs[session_key(ctx)] = str(chosen_pdf.pdf_name)
+        await message_scheduler.send(
             embed=embeded_text(f"You have chosen {chosen_pdf.pdf_title}", "PDF Chosen!")
         )
-    except Exception:
-        await channel.send(
+    elif pdfs:
+        embed = discord.Embed(title="Several PDFs match, choose one by id")
+        for pdf in pdfs:
+            embed.add_field(name=f"{pdf.id}. {pdf.pdf_title}", value="\u200b", inline=False)
+        await message_scheduler.send(embed=embed)
+    else:
+        await message_scheduler.send(
             embed=embeded_text(
-                f"Invalid Value chosen, Choose from 1-{len(pdfs)}", "Wrong Value!"
+                "No PDF matches, use an id or a title from !list", "Wrong Value!"
             )
         )
-        return
 
 
 @bot.command(name="describe")
-async def describe(ctx, message: str):
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
+async def describe(ctx, message: str, *options):
     filepath = os.path.join("pdfs", message.split("/")[-1])
-    await download_pdf(message, filepath)
-    namespace, pages = add_pdf_to_memory(filepath)
-    database_manager.create_pdf_file(namespace, filepath, message.split("/")[-1])
-    embed = create_pdf_embed(
-        summary=summarize_pdf(pages),
-        link=message,
-        title=message.split("/")[-1],
-        description="Pdf SUmmary",
+
+    async def notify_done(job: IngestionJob):
+        if job.status == "failed":
+            await message_scheduler.send(
+                embed=embeded_text(f"Could not describe {message}: {job.error}", "Error"),
+                priority=NOTICE,
+            )
+            return
+        embed = create_pdf_embed(
+            summary=job.summary,
+            link=message,
+            title=message.split("/")[-1],
+            description="Pdf SUmmary",
+        )
+        if job.profile_path:
+            embed.set_footer(text=f"Profile written to {job.profile_path}")
+        await message_scheduler.send(embed=embed, priority=NOTICE)
+
+    job = await ingestion_queue.submit(
+        filepath,
+        message,
+        message.split("/")[-1],
+        on_done=notify_done,
+        profile="profile" in options,
+        download=True,
+    )
+    await message_scheduler.send(
+        embed=embeded_text(f"Queued as job #{job.job_id}", "Information")
     )
-    await channel.send(embed=embed)
 
 
-@bot.command(name="list")
-async def list(ctx):
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
-    pdfs = database_manager.get_all_pdfs()
-    embed = discord.Embed(title="Available PDFs")
-    for i, pdf in enumerate(pdfs, start=1):
-        try:
-            name = f"{i}. {pdf.pdf_title} ({pdf.pdf_name.split('__')[1]})"
-        except Exception as e:
-            name = f"{i}. {pdf.pdf_title}"
-        embed.add_field(
-            name=name,
-            value="\u200b",
-            inline=False,
-        )
+@bot.command(name="jobs")
+async def jobs(ctx):
+    embed = discord.Embed(title="Ingestion Jobs")
+    for job in list(ingestion_queue.jobs.values())[-25:]:
+        embed.add_field(name=job.describe(), value="\u200b", inline=False)
+    if not ingestion_queue.jobs:
+        embed.add_field(name="No jobs yet", value="\u200b", inline=False)
+    await message_scheduler.send(embed=embed)
+
+
+@bot.command(name="cache")
+async def cache(ctx):
+    embed = discord.Embed(title="Answer Cache", description=answer_cache.stats.describe())
+    embed.add_field(name="Cached answers", value=str(len(answer_cache.entries)))
+    await message_scheduler.send(embed=embed)
+
+
+@bot.command(name="stats")
+async def stats(ctx):
+    embed = discord.Embed(title="Bot Stats")
+    spans = [
+        f"{name}: {count}x, p50 {p50:.2f}s, p95 {p95:.2f}s"
+        for name, count, _, p50, p95 in metrics.span_summary()
+    ]
+    embed.add_field(name="Timings", value="\n".join(spans)[:1024] or "Nothing yet", inline=False)
+
+    requests = metrics.counter_total("llm_requests_total")
+    prompt_tokens = metrics.counter_total("llm_tokens_total", kind="prompt")
+    completion_tokens = metrics.counter_total("llm_tokens_total", kind="completion")
+    cost = metrics.counter_total("llm_cost_usd_total")
+    embed.add_field(
+        name="LLM",
+        value=f"{requests:.0f} calls, {prompt_tokens:.0f}+{completion_tokens:.0f} tokens, ${cost:.4f}",
+        inline=False,
+    )
+
+    caches = [
+        f"{name}: {hits / (hits + misses):.0%} of {hits + misses:.0f}"
+        for name, (hits, misses) in sorted(metrics.cache_summary().items())
+    ]
+    embed.add_field(name="Cache hit rates", value="\n".join(caches)[:1024] or "Nothing yet", inline=False)
+
+    queues = [f"{name}: {series[()]:.0f}" for name, series in sorted(metrics.collect_gauges().items()) if () in series]
+    embed.add_field(name="Queues", value="\n".join(queues)[:1024] or "\u200b", inline=False)
+    await message_scheduler.send(embed=embed)
 
-    await channel.send(embed=embed)
+
+@bot.command(name="list")
+async def list_pdfs(ctx):
+    view = PDFListView(pages=pdf_list_pages)
+    await message_scheduler.send(embed=view.render(), view=view)
 
 
 @bot.command(name="commands")
 async def commands(ctx):
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
     embed = discord.Embed(title="Available Commands")
     embed.add_field(
         name="1. list",
@@ -148,7 +295,7 @@ async def commands(ctx):
     )
     embed.add_field(
         name="2. choose",
-        value="Allows the user to choose a PDF",
+        value="Allows the user to choose a PDF by id or title",
         inline=False,
     )
     embed.add_field(
@@ -158,34 +305,108 @@ async def commands(ctx):
     )
     embed.add_field(
         name="4. describe",
-        value="Downloads a pdf from a link and adds it to the database",
+        value="Downloads a pdf from a link and adds it to the database, add `profile` to write a sampling profile of the ingestion",
+        inline=False,
+    )
+    embed.add_field(
+        name="5. jobs",
+        value="Shows the status of PDFs being added to the database",
+        inline=False,
+    )
+    embed.add_field(
+        name="6. ask",
+        value="Answers a question across every paper in the knowledge base",
+        inline=False,
+    )
+    embed.add_field(
+        name="7. cache",
+        value="Shows how often chat answers are served from the cache",
         inline=False,
     )
-    await channel.send(embed=embed)
+    embed.add_field(
+        name="8. stats",
+        value="Shows timings, LLM usage, cache hit rates and queue depths",
+        inline=False,
+    )
+    await message_scheduler.send(embed=embed)
 
 
 @bot.command(name="chat")
 async def chat(ctx, *message):
-    channel = discord.utils.get(bot.get_all_channels(), name=channel_name)
-    pdf = database_manager.get_pdf_by_name(chosen_pdf_name)
+    chosen_pdf_name = chosen_pdfs.get(session_key(ctx))
+    pdf = database_manager.get_pdf_by_name(chosen_pdf_name) if chosen_pdf_name else None
     if not pdf:
-        await channel.send(
+        await message_scheduler.send(
             embed=embeded_text("Please choose a PDF using !choose", "No PDF available")
         )
+        return
+
+    chat = chat_sessions.get(pdf.namespace, session_key(ctx))
+    reply = StreamedReply(message_scheduler)
+    await reply.start()
+    try:
+        answer = await chat.achat(" ".join(message), on_text=reply.update)
+    except Exception as e:
+        print(f"Error answering {ctx.author}. Details {e}")
+        answer = "Sorry, something went wrong while answering."
+    await reply.finish(answer)
+
+
+@bot.command(name="ask")
+async def ask(ctx, *message):
+    global corpus_retrieval
+    question, filter = parse_corpus_filter(list(message))
+    if not question:
+        await message_scheduler.send(
+            embed=embeded_text(
+                "Usage: !ask [category:cs.AI] [since:2023-10-01] [until:...] [paper:<id>] <question>",
+                "No question",
+            )
+        )
+        return
 
-    chat = ChatRetrievalWithDB(
-        pdf.namespace,
+    if corpus_retrieval is None:
+        corpus_retrieval = CorpusRetrieval(get_corpus_store(), chat_sessions.condense_llm)
+    answer, papers = await asyncio.get_running_loop().run_in_executor(
+        None, corpus_retrieval.ask, question, filter
+    )
+    embed = discord.Embed(title="Answer", description=answer[:4096])
+    for paper in papers[:10]:
+        pages = ", ".join(str(page + 1) for page in paper["pages"] if page is not None)
+        embed.add_field(
+            name=f"{paper['title'] or paper['arxiv_id']} ({paper['arxiv_id']})"[:256],
+            value=f"{paper['link'] or 'no link'}" + (f" · pages {pages}" if pages else ""),
+            inline=False,
+        )
+    await message_scheduler.send(embed=embed)
+
+
+def main() -> None:
+    global chat_sessions
+    # Run through main.py, spawned PDF extraction workers re-run the script
+    # that started the bot and this module connects to everything at import.
+    chat_sessions = ChatSessionManager(
         creds["INDEX_NAME"],
-        HuggingFaceEmbeddings(),
+        get_embeddings(),
         ChatOpenAI(
             openai_api_key=creds["OPENAI_API_KEY"],
             model_name=config["MODEL_NAME"],
             temperature=0,
+            streaming=True,
+            callbacks=[llm_usage],
         ),
         chat_manager,
+        condense_llm=ChatOpenAI(
+            openai_api_key=creds["OPENAI_API_KEY"],
+            model_name=config["MODEL_NAME"],
+            temperature=0,
+            callbacks=[llm_usage],
+        ),
+        answer_cache=answer_cache,
     )
-    await channel.send((chat.chat(" ".join(message))))
+    message_scheduler.attach(bot, lambda papers: PaperDigestView(papers=papers))
+    bot.run(creds["BOT_TOKEN"])
 
 
 if __name__ == "__main__":
-    bot.run(creds["BOT_TOKEN"])
+    main()
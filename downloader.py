@@ -0,0 +1,123 @@
+import asyncio
+import importlib.util
+import os
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import metrics
+
+PDF_MAGIC = b"%PDF"
+
+
+class DownloadError(Exception):
+    pass
+
+
+class PDFDownloader:
+    def __init__(
+        self,
+        max_connections: int = 10,
+        retries: int = 3,
+        backoff: float = 1.0,
+        chunk_size: int = 64 * 1024,
+        timeout: float = 60.0,
+    ) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+            follow_redirects=True,
+        )
+
+    async def download(self, link: str, filename: str) -> str:
+        # Two downloads of one file (a digest "Add" and !describe) would
+        # write and resume the same .part file, the second one waits for the
+        # first instead.
+        key = os.path.abspath(filename)
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.download_with_retries(link, filename))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def download_with_retries(self, link: str, filename: str) -> str:
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.span("download"):
+                    await self.download_once(link, filename)
+                return filename
+            except (httpx.HTTPError, DownloadError) as e:
+                if attempt == self.retries or not self.retryable(e):
+                    raise DownloadError(f"Failed to download {link}: {e}") from e
+                metrics.inc("download_retries_total")
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+    def retryable(self, error: Exception) -> bool:
+        # A 404, 403 or 410 will not change on retry, only transport errors,
+        # 5xx, 429 and our own checks (a short or non-PDF body) are retried.
+        if isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        if isinstance(error, httpx.UnsupportedProtocol):
+            return False
+        return isinstance(error, (httpx.TransportError, DownloadError))
+
+    async def download_once(self, link: str, filename: str) -> None:
+        part_file = f"{filename}.part"
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        async with self.client.stream("GET", link, headers=headers) as response:
+            if response.status_code == 416:
+                os.remove(part_file)
+                raise DownloadError("Stale partial download discarded")
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            expected_size = self.expected_size(response, offset)
+
+            with open(part_file, "ab" if offset else "wb") as fp:
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    fp.write(chunk)
+
+        self.verify(part_file, expected_size)
+        os.replace(part_file, filename)
+
+    def expected_size(self, response: httpx.Response, offset: int) -> Optional[int]:
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            return int(total) if total.isdigit() else None
+        content_length = response.headers.get("Content-Length")
+        if content_length is None or response.headers.get("Content-Encoding"):
+            return None
+        return offset + int(content_length)
+
+    def verify(self, part_file: str, expected_size: Optional[int]) -> None:
+        size = os.path.getsize(part_file)
+        if expected_size is not None and size != expected_size:
+            # A short file is kept so the next attempt can resume it.
+            if size > expected_size:
+                os.remove(part_file)
+            raise DownloadError(f"Expected {expected_size} bytes, got {size}")
+
+        with open(part_file, "rb") as fp:
+            magic = fp.read(len(PDF_MAGIC))
+        if magic != PDF_MAGIC:
+            os.remove(part_file)
+            raise DownloadError("Response is not a PDF")
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+downloader = PDFDownloader()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from peewee import *
+
+from metrics import metrics
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        directory: str,
+        model_id: str,
+        max_bytes: int = 512 * 1024 * 1024,
+        dtype: str = "float16",
+    ) -> None:
+        # Each model gets its own directory, so a row is addressed by
+        # (model id, sha256 of the text) and vectors of different sizes
+        # never share a matrix.
+        self.directory = os.path.join(directory, text_hash(model_id)[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.meta_file = os.path.join(self.directory, "meta.json")
+        self.vectors_file = os.path.join(self.directory, "vectors.bin")
+        self.meta = self.read_meta_file(dtype)
+        self.vectors = None
+
+        db = SqliteDatabase(
+            os.path.join(self.directory, "index.db"),
+            pragmas={"journal_mode": "wal", "synchronous": "normal"},
+        )
+
+        class CachedVector(Model):
+            text_hash = CharField(primary_key=True)
+            slot = IntegerField(unique=True)
+            last_used = FloatField(index=True)
+
+            class Meta:
+                database = db
+
+        self.db = db
+        self.model = CachedVector
+        db.connect(reuse_if_open=True)
+        db.create_tables([CachedVector], safe=True)
+
+    def read_meta_file(self, dtype: str) -> dict:
+        try:
+            with open(self.meta_file, "rt") as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"model_id": self.model_id, "dtype": dtype, "dim": None, "capacity": 0}
+
+    def write_meta_file(self) -> None:
+        tmp_file = f"{self.meta_file}.tmp"
+        with open(tmp_file, "wt") as fp:
+            json.dump(self.meta, fp)
+        os.replace(tmp_file, self.meta_file)
+
+    @property
+    def max_entries(self) -> int:
+        row_bytes = self.meta["dim"] * np.dtype(self.meta["dtype"]).itemsize
+        return max(1, self.max_bytes // row_bytes)
+
+    def open_vectors(self, capacity: int) -> np.memmap:
+        with open(self.vectors_file, "ab") as fp:
+            row_bytes = self.meta["dim"] * np.dtype(self.meta["dtype"]).itemsize
+            if fp.tell() < capacity * row_bytes:
+                fp.truncate(capacity * row_bytes)
+        self.meta["capacity"] = capacity
+        self.write_meta_file()
+        return np.memmap(
+            self.vectors_file,
+            dtype=self.meta["dtype"],
+            mode="r+",
+            shape=(capacity, self.meta["dim"]),
+        )
+
+    def ensure_capacity(self, dim: int, needed: int) -> None:
+        if self.meta["dim"] is None:
+            self.meta["dim"] = dim
+        elif self.meta["dim"] != dim:
+            raise ValueError(f"Expected {self.meta['dim']} dimensions, got {dim}")
+
+        capacity = self.meta["capacity"]
+        if self.vectors is None and capacity:
+            self.vectors = self.open_vectors(capacity)
+        if needed > capacity:
+            capacity = min(max(needed, capacity * 2, 1024), self.max_entries)
+            if self.vectors is not None:
+                self.vectors.flush()
+            self.vectors = self.open_vectors(capacity)
+
+    def get_many(self, hashes: List[str]) -> Dict[str, List[float]]:
+        with self.lock:
+            if not hashes or self.meta["dim"] is None:
+                return {}
+            self.ensure_capacity(self.meta["dim"], 0)
+            found = {}
+            for batch in chunked(list(set(hashes)), 500):
+                query = self.model.select(self.model.text_hash, self.model.slot).where(
+                    self.model.text_hash.in_(batch)
+                )
+                for row_hash, slot in query.tuples():
+                    found[row_hash] = self.vectors[slot].astype(np.float32).tolist()
+            if found:
+                self.model.update(last_used=time.time()).where(
+                    self.model.text_hash.in_(list(found))
+                ).execute()
+            return found
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        if not vectors:
+            return
+        with self.lock:
+            dim = len(next(iter(vectors.values())))
+            self.ensure_capacity(dim, 0)
+            known = {
+                row_hash
+                for (row_hash,) in self.model.select(self.model.text_hash)
+                .where(self.model.text_hash.in_(list(vectors)))
+                .tuples()
+            }
+            new_hashes = [row_hash for row_hash in vectors if row_hash not in known]
+            if not new_hashes:
+                return
+
+            slots = self.allocate_slots(dim, len(new_hashes))
+            now = time.time()
+            for row_hash, slot in zip(new_hashes, slots):
+                self.vectors[slot] = np.asarray(vectors[row_hash], dtype=self.meta["dtype"])
+            self.vectors.flush()
+
+            rows = [
+                {"text_hash": row_hash, "slot": slot, "last_used": now}
+                for row_hash, slot in zip(new_hashes, slots)
+            ]
+            with self.db.atomic():
+                for batch in chunked(rows, 100):
+                    self.model.insert_many(batch).execute()
+
+    def allocate_slots(self, dim: int, count: int) -> List[int]:
+        used = self.model.select().count()
+        next_slot = self.model.select(fn.MAX(self.model.slot)).scalar()
+        next_slot = 0 if next_slot is None else next_slot + 1
+        fresh = min(count, self.max_entries - next_slot)
+        slots = list(range(next_slot, next_slot + max(fresh, 0)))
+        self.ensure_capacity(dim, next_slot + len(slots))
+
+        # Past the size budget the least recently used rows give up their
+        # slots to the new vectors.
+        reuse = count - len(slots)
+        if reuse > 0:
+            evicted = list(
+                self.model.select(self.model.text_hash, self.model.slot)
+                .order_by(self.model.last_used)
+                .limit(min(reuse, used))
+                .tuples()
+            )
+            with self.db.atomic():
+                for batch in chunked([row_hash for row_hash, _ in evicted], 500):
+                    self.model.delete().where(self.model.text_hash.in_(batch)).execute()
+            slots.extend(slot for _, slot in evicted)
+        return slots[:count]
+
+    def __len__(self) -> int:
+        return self.model.select().count()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, cache: EmbeddingCache) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+
+    @property
+    def model_id(self) -> str:
+        return self.cache.model_id
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        found = self.cache.get_many(hashes)
+
+        missing: Dict[str, str] = {}
+        for row_hash, text in zip(hashes, texts):
+            if row_hash not in found:
+                missing.setdefault(row_hash, text)
+        metrics.cache("embedding", hits=len(texts) - len(missing), misses=len(missing))
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing, computed))
+            self.cache.put_many(new_vectors)
+            found.update(new_vectors)
+
+        return [found[row_hash] for row_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries get their own key space in case the model embeds them
+        # differently from documents.
+        row_hash = text_hash(f"query:{text}")
+        found = self.cache.get_many([row_hash])
+        metrics.cache("embedding", hits=row_hash in found, misses=row_hash not in found)
+        if row_hash not in found:
+            found[row_hash] = self.embeddings.embed_query(text)
+            self.cache.put_many(found)
+        return found[row_hash]
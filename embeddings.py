@@ -0,0 +1,90 @@
+import threading
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from globals import config
+from metrics import metrics
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+DEFAULT_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+class EmbeddingService(Embeddings):
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL_NAME,
+        batch_size: int = 32,
+        backend: str = "torch",
+        onnx_file: str = DEFAULT_ONNX_FILE,
+    ) -> None:
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unknown embedding backend {backend}")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.backend = backend
+        self.onnx_file = onnx_file
+        self.client = None
+        self.lock = threading.Lock()
+
+    @property
+    def model_id(self) -> str:
+        if self.backend == "onnx":
+            return f"{self.model_name}:{self.onnx_file}"
+        return self.model_name
+
+    def load(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self.load_model()
+        return self.client
+
+    def load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        if self.backend == "onnx":
+            # The int8 ONNX export runs on CPU only and produces vectors of
+            # the same dimension, so it can serve an index built with torch.
+            # backend= needs sentence-transformers>=3.2 with its [onnx] extra.
+            return SentenceTransformer(
+                self.model_name,
+                backend="onnx",
+                model_kwargs={"file_name": self.onnx_file},
+            )
+        return SentenceTransformer(self.model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [text.replace("\n", " ") for text in texts]
+        with metrics.span("embed"):
+            embeddings = self.load().encode(texts, batch_size=self.batch_size)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+embedding_service = None
+embedding_service_lock = threading.Lock()
+
+
+def get_embeddings() -> Embeddings:
+    global embedding_service
+    if embedding_service is None:
+        with embedding_service_lock:
+            if embedding_service is None:
+                service = EmbeddingService(
+                    model_name=config.get("EMBEDDING_MODEL", DEFAULT_MODEL_NAME),
+                    batch_size=config.get("EMBEDDING_BATCH_SIZE", 32),
+                    backend=config.get("EMBEDDING_BACKEND", "torch"),
+                )
+                if config.get("EMBEDDING_CACHE_DIR"):
+                    cache = EmbeddingCache(
+                        config["EMBEDDING_CACHE_DIR"],
+                        service.model_id,
+                        max_bytes=config.get("EMBEDDING_CACHE_MB", 512) * 1024 * 1024,
+                    )
+                    service = CachedEmbeddings(service, cache)
+                embedding_service = service
+    return embedding_service
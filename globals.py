@@ -1,14 +1,18 @@
 from peewee import SqliteDatabase
-from data_storage import PDFFileManager, ChatManager
+from data_storage import PDFFileManager, ChatManager, PaperManager, SQLITE_PRAGMAS
+from history_store import HistoryStore
+from listing_cache import ListingCache
 from pinecone_client import initialize_pinecone
 from utils import load_config, load_credentials
 
-db = SqliteDatabase('database/names.db')
+db = SqliteDatabase('database/names.db', pragmas=SQLITE_PRAGMAS, timeout=10)
 monitor_interval = 30
 channel_name = "general"
-chosen_pdf_name = ""
 database_manager = PDFFileManager(db = db)
 chat_manager = ChatManager(db = db)
+paper_manager = PaperManager(db = db)
+listing_cache = ListingCache("cache/listing_cache.json")
+history_store = HistoryStore(db, legacy_file="history_file.txt", bloom=True)
 creds = load_credentials()
 config = load_config()
 initialize_pinecone(creds["PINECONE_API_KEY"], creds["PINECONE_ENVIRONMENT"])
@@ -0,0 +1,125 @@
+import hashlib
+import math
+import os
+from datetime import datetime
+from typing import Iterable, Iterator, Set
+
+from peewee import *
+
+
+def arxiv_id_from_link(link: str) -> str:
+    arxiv_id = link.split("/pdf/", 1)[-1]
+    return arxiv_id[:-4] if arxiv_id.endswith(".pdf") else arxiv_id
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = 100_000, error_rate: float = 0.001) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Adds, duplicates included, so the filter reports full early rather
+        # than late.
+        self.count = 0
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key: str) -> None:
+        self.count += 1
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    @property
+    def full(self) -> bool:
+        # Past its capacity the false-positive rate climbs above error_rate.
+        return self.count >= self.capacity
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+class HistoryStore:
+    def __init__(
+        self,
+        db: SqliteDatabase,
+        legacy_file: str | None = None,
+        bloom: bool = False,
+        bloom_error_rate: float = 0.001,
+        bloom_headroom: float = 2.0,
+    ) -> None:
+        class SeenPaper(Model):
+            arxiv_id = CharField(primary_key=True)
+            link = CharField()
+            added_at = DateTimeField(default=datetime.now)
+
+            class Meta:
+                database = db
+
+        self.db = db
+        self.model = SeenPaper
+        self.bloom = None
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_headroom = bloom_headroom
+        db.connect(reuse_if_open=True)
+        db.create_tables([SeenPaper], safe=True)
+
+        if legacy_file is not None:
+            self.migrate_history_file(legacy_file)
+        if bloom:
+            self.rebuild_bloom()
+
+    def rebuild_bloom(self) -> None:
+        # Sized from the history with room to grow, and rebuilt bigger once
+        # that room is used up instead of silently losing accuracy.
+        capacity = max(100_000, int(len(self) * self.bloom_headroom))
+        bloom = BloomFilter(capacity, self.bloom_error_rate)
+        for (arxiv_id,) in self.model.select(self.model.arxiv_id).tuples().iterator():
+            bloom.add(arxiv_id)
+        self.bloom = bloom
+
+    def migrate_history_file(self, filename: str) -> None:
+        if not os.path.exists(filename):
+            return
+        with open(filename, "rt") as fp:
+            self.add_many(line.strip() for line in fp if line.strip())
+        os.replace(filename, f"{filename}.migrated")
+
+    def __contains__(self, link: str) -> bool:
+        return not self.filter_new([link])
+
+    def filter_new(self, links: Iterable[str]) -> Set[str]:
+        ids = {arxiv_id_from_link(link): link for link in links}
+        candidates = [
+            arxiv_id for arxiv_id in ids if self.bloom is None or arxiv_id in self.bloom
+        ]
+        known = set()
+        for batch in chunked(candidates, 500):
+            query = self.model.select(self.model.arxiv_id).where(
+                self.model.arxiv_id.in_(batch)
+            )
+            known.update(arxiv_id for (arxiv_id,) in query.tuples())
+        return {link for arxiv_id, link in ids.items() if arxiv_id not in known}
+
+    def add_many(self, links: Iterable[str]) -> None:
+        rows = [
+            {"arxiv_id": arxiv_id_from_link(link), "link": link} for link in links
+        ]
+        with self.db.atomic():
+            for batch in chunked(rows, 100):
+                self.model.insert_many(batch).on_conflict_ignore().execute()
+        if self.bloom is not None:
+            for row in rows:
+                self.bloom.add(row["arxiv_id"])
+            if self.bloom.full:
+                self.rebuild_bloom()
+
+    def __len__(self) -> int:
+        return self.model.select().count()
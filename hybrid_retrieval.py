@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+from typing import Any, Dict, List, Tuple
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.docstore.document import Document
+from langchain.schema.retriever import BaseRetriever
+from langchain.vectorstores.base import VectorStore
+from peewee import SqliteDatabase, chunked
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
+
+from metrics import metrics
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how in is it of on or that the "
+    "their they this to was what when where which who why with".split()
+)
+
+
+def query_terms(text: str) -> List[str]:
+    terms = []
+    for term in re.findall(r"\w+", text.lower()):
+        if term not in STOPWORDS and term not in terms:
+            terms.append(term)
+    return terms
+
+
+def namespace_key(namespace: str) -> str:
+    # Namespaces are file paths, the key is a single token FTS5 can match.
+    return "ns" + hashlib.sha1(namespace.encode()).hexdigest()
+
+
+class KeywordIndex:
+    def __init__(self, path: str) -> None:
+        db = SqliteDatabase(path, pragmas={"journal_mode": "wal", "synchronous": "normal"}, timeout=10)
+
+        class KeywordChunk(FTS5Model):
+            rowid = RowIDField()
+            namespace_key = SearchField()
+            text = SearchField()
+            namespace = SearchField(unindexed=True)
+            chunk_id = SearchField(unindexed=True)
+            metadata = SearchField(unindexed=True)
+
+            class Meta:
+                database = db
+                options = {"tokenize": "porter unicode61"}
+
+        self.db = db
+        self.model = KeywordChunk
+        db.connect(reuse_if_open=True)
+        db.create_tables([KeywordChunk], safe=True)
+
+    def scope(self, namespace: str) -> str:
+        return f'namespace_key : "{namespace_key(namespace)}"'
+
+    def delete(self, namespace: str) -> None:
+        rowids = self.model.select(self.model.rowid).where(self.model.match(self.scope(namespace)))
+        self.model.delete().where(self.model.rowid.in_(rowids)).execute()
+
+    def add(self, namespace: str, ids: List[str], texts: List[str], metadatas: List[dict]) -> None:
+        # Replaces everything indexed for the namespace, so re-ingesting a
+        # paper that now has fewer chunks leaves nothing stale behind.
+        key = namespace_key(namespace)
+        rows = [
+            (key, text, namespace, chunk_id, json.dumps(metadata))
+            for chunk_id, text, metadata in zip(ids, texts, metadatas)
+        ]
+        fields = [
+            self.model.namespace_key,
+            self.model.text,
+            self.model.namespace,
+            self.model.chunk_id,
+            self.model.metadata,
+        ]
+        # IMMEDIATE takes the write lock up front, a deferred transaction that
+        # reads before deleting fails at once when another ingest is writing.
+        with self.db.atomic(lock_type="IMMEDIATE"):
+            self.delete(namespace)
+            for batch in chunked(rows, 100):
+                self.model.insert_many(batch, fields=fields).execute()
+
+    def search(self, namespace: str, query: str, k: int = 20) -> List[Tuple[Document, float]]:
+        terms = query_terms(query)
+        if not terms:
+            return []
+        any_term = " OR ".join(f'"{term}"' for term in terms)
+        match = f"{self.scope(namespace)} AND text : ({any_term})"
+        # bm25() is lower for better matches, the namespace column gets no weight.
+        rank = self.model.bm25(0.0, 1.0)
+        rows = (
+            self.model.select(self.model.text, self.model.metadata, rank.alias("rank"))
+            .where(self.model.match(match))
+            .order_by(rank)
+            .limit(k)
+            .tuples()
+        )
+        return [
+            (Document(page_content=text, metadata=json.loads(metadata)), -score)
+            for text, metadata, score in rows
+        ]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Document]], k: int = 60, weights: List[float] | None = None
+) -> List[Document]:
+    # Each list votes weight / (k + rank) for its documents. Chunks are
+    # matched by their text, the only thing both retrievers return for them.
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, document in enumerate(ranking):
+            documents.setdefault(document.page_content, document)
+            scores[document.page_content] = scores.get(document.page_content, 0.0) + weight / (k + rank + 1)
+    return [documents[text] for text in sorted(scores, key=scores.get, reverse=True)]
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str, batch_size: int = 16) -> None:
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.client = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from sentence_transformers import CrossEncoder
+
+                    self.client = CrossEncoder(self.model_name, device="cpu")
+        return self.client
+
+    def rerank(self, query: str, documents: List[Document], top_n: int) -> List[Document]:
+        if not documents:
+            return []
+        scores = self.load().predict(
+            [(query, document.page_content) for document in documents], batch_size=self.batch_size
+        )
+        ranked = sorted(zip(documents, scores), key=lambda pair: pair[1], reverse=True)
+        return [document for document, _ in ranked[:top_n]]
+
+
+class HybridRetriever(BaseRetriever):
+    vectorstore: VectorStore
+    keyword_index: KeywordIndex
+    namespace: str
+    k: int = 4
+    fetch_k: int = 20
+    # Unweighted RRF with k=60 let chunks the vector search ranked middling
+    # outvote BM25's exact-term hits, see benchmarks/retrieval_bench.py.
+    # A small k with BM25 weighted up keeps those hits on top and lets the
+    # vector results fill in and break ties.
+    rrf_k: int = 2
+    dense_weight: float = 0.3
+    keyword_weight: float = 1.0
+    reranker: Any = None
+    rerank_candidates: int = 12
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def retrieve(self, query: str) -> List[Document]:
+        with metrics.span("retrieve"):
+            return self.retrieve_documents(query)
+
+    def retrieve_documents(self, query: str) -> List[Document]:
+        dense = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        keyword = [document for document, _ in self.keyword_index.search(self.namespace, query, self.fetch_k)]
+        fused = reciprocal_rank_fusion(
+            [dense, keyword], self.rrf_k, [self.dense_weight, self.keyword_weight]
+        )
+        if self.reranker is not None:
+            return self.reranker.rerank(query, fused[: self.rerank_candidates], self.k)
+        return fused[: self.k]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.retrieve(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.retrieve, query)
@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List
+
+from data_storage import PDFFileManager
+from globals import config, database_manager
+from metrics import metrics, profile
+from openai_utils import load_pdf_pages, pdf_metadata, store_pdf_pages, summarize_pdf
+from utils import download_pdf
+
+
+class IngestionJob:
+    def __init__(
+        self,
+        job_id: int,
+        filepath: str,
+        link: str,
+        title: str,
+        on_done: Callable[["IngestionJob"], Awaitable[None]] | None,
+        metadata: dict | None = None,
+        profile: bool = False,
+        download: bool = False,
+    ) -> None:
+        self.job_id = job_id
+        self.filepath = filepath
+        self.link = link
+        self.title = title
+        self.on_done = on_done
+        self.metadata = metadata or pdf_metadata(filepath, link)
+        self.profile = profile
+        self.download = download
+        self.profile_path = None
+        self.status = "queued"
+        self.progress = ""
+        self.namespace = None
+        self.summary = None
+        self.error = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.created_at
+
+    def describe(self) -> str:
+        progress = f" ({self.progress})" if self.progress else ""
+        return f"#{self.job_id} {self.title}: {self.status}{progress}, {self.elapsed():.0f}s"
+
+
+class IngestionQueue:
+    def __init__(
+        self,
+        pdf_manager: PDFFileManager,
+        workers: int = 2,
+        thread_workers: int = 4,
+        keep_finished: int = 50,
+    ) -> None:
+        self.pdf_manager = pdf_manager
+        self.worker_count = workers
+        self.keep_finished = keep_finished
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.jobs: Dict[int, IngestionJob] = {}
+        self.ids = itertools.count(1)
+        self.workers: List[asyncio.Task] = []
+        # PDF parsing fans out to the extractor's own process pool, the
+        # threads here mostly wait on it, on embedding, upserts and the LLM.
+        self.thread_pool = ThreadPoolExecutor(thread_workers)
+
+    def start(self) -> None:
+        if self.workers:
+            return
+        self.workers = [
+            asyncio.create_task(self.worker()) for _ in range(self.worker_count)
+        ]
+
+    async def submit(
+        self,
+        filepath: str,
+        link: str,
+        title: str,
+        on_done: Callable[[IngestionJob], Awaitable[None]] | None = None,
+        metadata: dict | None = None,
+        profile: bool = False,
+        download: bool = False,
+    ) -> IngestionJob:
+        self.start()
+        job = IngestionJob(next(self.ids), filepath, link, title, on_done, metadata, profile, download)
+        self.jobs[job.job_id] = job
+        self.prune()
+        await self.queue.put(job)
+        return job
+
+    def prune(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    async def worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_profiled(job)
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                print(f"Ingestion of {job.filepath} failed. Details {e}")
+            finally:
+                job.finished_at = time.monotonic()
+                metrics.inc("ingestion_jobs_total", status=job.status)
+                self.queue.task_done()
+
+            if job.on_done is not None:
+                try:
+                    await job.on_done(job)
+                except Exception as e:
+                    print(f"Error notifying job #{job.job_id}. Details {e}")
+
+    async def run_profiled(self, job: IngestionJob) -> None:
+        # The sampler sees every thread, so a profiled job is best run while
+        # nothing else is being ingested.
+        if not job.profile:
+            with metrics.span("ingest"):
+                await self.run_job(job)
+            return
+        job.profile_path = os.path.join(
+            config.get("PROFILE_DIR", "profiles"), f"job-{job.job_id}-{int(time.time())}.folded"
+        )
+        with profile(job.profile_path), metrics.span("ingest"):
+            await self.run_job(job)
+
+    async def run_job(self, job: IngestionJob) -> None:
+        loop = asyncio.get_running_loop()
+
+        if job.download:
+            # Fetched inside the job, so a bad link fails the job and reaches
+            # on_done like any other error.
+            job.status = "downloading"
+            await download_pdf(job.link, job.filepath)
+
+        job.status = "parsing"
+        pages = await loop.run_in_executor(self.thread_pool, load_pdf_pages, job.filepath)
+
+        job.status = "embedding"
+        job.progress = f"{len(pages)} chunks"
+        job.namespace = await loop.run_in_executor(
+            self.thread_pool, store_pdf_pages, job.filepath, pages, job.metadata
+        )
+        await loop.run_in_executor(
+            self.thread_pool,
+            self.pdf_manager.create_pdf_file,
+            job.namespace,
+            job.filepath,
+            job.title,
+        )
+
+        job.status = "summarizing"
+        job.summary = await loop.run_in_executor(self.thread_pool, summarize_pdf, pages)
+        job.status = "done"
+        job.progress = ""
+
+
+ingestion_queue = IngestionQueue(database_manager)
+metrics.register_gauge("ingestion_queue_depth", ingestion_queue.pending)
+metrics.register_gauge(
+    "ingestion_jobs_running",
+    lambda: sum(not job.finished and job.status != "queued" for job in ingestion_queue.jobs.values()),
+)
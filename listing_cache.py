@@ -0,0 +1,88 @@
+import contextlib
+import json
+import os
+from typing import Dict, Optional, Set, Tuple
+
+import httpx
+
+
+class ListingCache:
+    def __init__(self, cache_file: str) -> None:
+        self.cache_file = cache_file
+        self.data = self.read_cache_file(cache_file)
+        self.pages: Dict[str, dict] = self.data.setdefault("pages", {})
+        self.seen: Dict[str, list] = self.data.setdefault("seen", {})
+        self.dirty = False
+
+    def read_cache_file(self, filename: str) -> dict:
+        with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
+            with open(filename, "rt") as fp:
+                return json.load(fp)
+        return {}
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        entry = self.pages.get(url, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def digest_matches(self, url: str, digest: str) -> bool:
+        return self.pages.get(url, {}).get("sha256") == digest
+
+    def get_listing(
+        self, url: str
+    ) -> Optional[Tuple[Dict[str, Set[str]], Dict[str, str], int]]:
+        entry = self.pages.get(url)
+        if entry is None:
+            return None
+        links = {date: set(date_links) for date, date_links in entry["links"].items()}
+        # Entries written before the count was stored fall back to the links.
+        entries = entry.get("entries", sum(len(date_links) for date_links in links.values()))
+        return links, dict(entry["titles"]), entries
+
+    def store_listing(
+        self,
+        url: str,
+        response: httpx.Response,
+        digest: str,
+        links: Dict[str, Set[str]],
+        title_dict: Dict[str, str],
+        entries: int,
+    ) -> None:
+        entry = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": digest,
+            "links": {date: sorted(date_links) for date, date_links in links.items()},
+            "titles": title_dict,
+            "entries": entries,
+        }
+        if self.pages.get(url) != entry:
+            self.pages[url] = entry
+            self.dirty = True
+
+    def new_links(self, key: str, listed: Set[str]) -> Set[str]:
+        return listed.difference(self.seen.get(key, ()))
+
+    def mark_seen(self, key: str, handled: Set[str], listed: Set[str]) -> None:
+        # Only links still on the listing are kept, so the seen set stays
+        # bounded by the size of the listing itself.
+        seen = listed.intersection(self.seen.get(key, ())).union(handled & listed)
+        if seen != set(self.seen.get(key, ())):
+            self.seen[key] = sorted(seen)
+            self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "wt") as fp:
+            json.dump(self.data, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
@@ -0,0 +1,7 @@
+# Starts the bot. PDF extraction workers are spawned, and spawn re-runs the
+# starting script in every worker, so this one imports nothing unless it is
+# the script being run.
+if __name__ == "__main__":
+    from discord_bot import main
+
+    main()
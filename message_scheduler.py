@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, List
+
+import discord
+
+from globals import channel_name
+from metrics import metrics
+
+REPLY = 0
+NOTICE = 1
+DIGEST = 2
+
+MAX_EMBEDS = 10
+
+
+class RouteBucket:
+    # Discord allows about 5 messages per 5 seconds on a channel route, the
+    # bucket keeps us under that instead of relying on 429 retries.
+    def __init__(self, rate: int = 5, per: float = 5.0) -> None:
+        self.rate = rate
+        self.per = per
+        self.sent: List[float] = []
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.sent = [sent_at for sent_at in self.sent if now - sent_at < self.per]
+            if len(self.sent) < self.rate:
+                self.sent.append(now)
+                return
+            await asyncio.sleep(self.per - (now - self.sent[0]))
+
+
+class OutboundMessage:
+    def __init__(self, channel, kwargs: dict, future: asyncio.Future) -> None:
+        self.channel = channel
+        self.kwargs = kwargs
+        self.future = future
+
+
+class MessageScheduler:
+    def __init__(
+        self,
+        channel_name: str,
+        rate: int = 5,
+        per: float = 5.0,
+        linger: float = 2.0,
+        max_parked: int = 100,
+    ) -> None:
+        self.channel_name = channel_name
+        self.rate = rate
+        self.per = per
+        self.linger = linger
+        self.max_parked = max_parked
+        self.parked: List[tuple] = []
+        self.bot = None
+        self.channel = None
+        self.sequence = itertools.count()
+        self.queues: Dict[int, asyncio.PriorityQueue] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.digest: List[tuple] = []
+        self.digest_view_factory = None
+        self.flush_task = None
+
+    def attach(self, bot, digest_view_factory=None) -> None:
+        self.bot = bot
+        self.digest_view_factory = digest_view_factory
+
+    def get_channel(self):
+        if self.channel is None and self.bot is not None:
+            self.channel = discord.utils.get(self.bot.get_all_channels(), name=self.channel_name)
+        return self.channel
+
+    def invalidate_channel(self, *args) -> None:
+        self.channel = None
+        if self.parked and self.get_channel() is not None:
+            parked, self.parked = self.parked, []
+            for priority, message in parked:
+                message.channel = self.channel
+                self.enqueue(priority, message)
+
+    def post(self, *, priority: int = REPLY, channel=None, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        message = OutboundMessage(channel or self.get_channel(), kwargs, future)
+        if message.channel is None:
+            # Not in the guild yet or the channel was renamed. The message
+            # waits for invalidate_channel to find the channel again, past
+            # `max_parked` the oldest are dropped.
+            print(f"No channel named {self.channel_name}, holding the message")
+            metrics.inc("discord_messages_parked_total")
+            self.parked.append((priority, message))
+            while len(self.parked) > self.max_parked:
+                _, dropped = self.parked.pop(0)
+                dropped.future.cancel()
+                metrics.inc("discord_messages_dropped_total")
+            return future
+        self.enqueue(priority, message)
+        return future
+
+    def enqueue(self, priority: int, message: OutboundMessage) -> None:
+        route = message.channel.id
+        if route not in self.queues:
+            self.queues[route] = asyncio.PriorityQueue()
+            self.workers[route] = asyncio.create_task(
+                self.route_worker(self.queues[route], RouteBucket(self.rate, self.per))
+            )
+        self.queues[route].put_nowait((priority, next(self.sequence), message))
+
+    async def send(self, *, priority: int = REPLY, channel=None, **kwargs) -> discord.Message:
+        return await self.post(priority=priority, channel=channel, **kwargs)
+
+    async def route_worker(self, queue: asyncio.PriorityQueue, bucket: RouteBucket) -> None:
+        while True:
+            _, _, message = await queue.get()
+            try:
+                await bucket.acquire()
+                metrics.inc("discord_messages_total")
+                sent = await message.channel.send(**message.kwargs)
+                if not message.future.done():
+                    message.future.set_result(sent)
+            except Exception as e:
+                print(f"Error sending message. Details {e}")
+                if not message.future.done():
+                    message.future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    def post_digest(self, embed: discord.Embed, item=None) -> None:
+        # Papers wait up to `linger` seconds so a burst goes out as a few
+        # messages of MAX_EMBEDS embeds instead of one message each.
+        self.digest.append((embed, item))
+        if len(self.digest) >= MAX_EMBEDS:
+            self.flush_digest()
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.linger)
+        self.flush_digest()
+
+    def flush_digest(self) -> List[asyncio.Future]:
+        futures = []
+        while self.digest:
+            batch, self.digest = self.digest[:MAX_EMBEDS], self.digest[MAX_EMBEDS:]
+            kwargs = {"embeds": [embed for embed, _ in batch]}
+            items = [item for _, item in batch if item is not None]
+            if items and self.digest_view_factory is not None:
+                kwargs["view"] = self.digest_view_factory(items)
+            futures.append(self.post(priority=DIGEST, **kwargs))
+        return futures
+
+    async def drain(self) -> None:
+        self.flush_digest()
+        await asyncio.gather(*(queue.join() for queue in self.queues.values()))
+
+
+class StreamedReply:
+    # A reply that grows as the answer streams in. Edits are throttled to
+    # one per `interval` and never queue up behind each other.
+    def __init__(self, scheduler: MessageScheduler, channel=None, interval: float = 1.0, limit: int = 2000) -> None:
+        self.scheduler = scheduler
+        self.channel = channel
+        self.interval = interval
+        self.limit = limit
+        self.message = None
+        self.last_edit = 0.0
+        self.pending = None
+
+    async def start(self, placeholder: str = "…") -> None:
+        self.message = await self.scheduler.send(content=placeholder, channel=self.channel)
+
+    async def update(self, text: str) -> None:
+        now = time.monotonic()
+        if not text or now - self.last_edit < self.interval:
+            return
+        if self.pending is not None and not self.pending.done():
+            return
+        self.last_edit = now
+        self.pending = asyncio.create_task(self.message.edit(content=text[: self.limit]))
+
+    async def finish(self, text: str) -> None:
+        if self.pending is not None:
+            await asyncio.gather(self.pending, return_exceptions=True)
+        text = text or "…"
+        await self.message.edit(content=text[: self.limit])
+        for start in range(self.limit, len(text), self.limit):
+            self.scheduler.post(content=text[start:start + self.limit], channel=self.channel)
+
+
+message_scheduler = MessageScheduler(channel_name)
+metrics.register_gauge(
+    "outbound_queue_depth", lambda: sum(queue.qsize() for queue in message_scheduler.queues.values())
+)
+metrics.register_gauge("digest_pending", lambda: len(message_scheduler.digest))
+metrics.register_gauge("outbound_parked", lambda: len(message_scheduler.parked))
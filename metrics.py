@@ -0,0 +1,289 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import tiktoken
+from aiohttp import web
+from langchain.callbacks.base import BaseCallbackHandler
+
+PREFIX = "arxiv_bot"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# USD per 1K prompt and completion tokens, models not listed cost nothing.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+
+def label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        # Recent samples for the percentiles !stats shows.
+        self.recent = deque(maxlen=1024)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))] if ordered else 0.0
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.gauges: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.gauge_callbacks: Dict[str, Callable[[], float]] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def register_gauge(self, name: str, callback: Callable[[], float]) -> None:
+        # Read when the metrics are collected, for queue depths and sizes.
+        self.gauge_callbacks[name] = callback
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def cache(self, name: str, hits: int = 0, misses: int = 0) -> None:
+        if hits:
+            self.inc("cache_requests_total", hits, cache=name, result="hit")
+        if misses:
+            self.inc("cache_requests_total", misses, cache=name, result="miss")
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("span_errors_total", span=name)
+            raise
+        finally:
+            self.observe("span_seconds", time.perf_counter() - start, span=name)
+
+    def collect_gauges(self) -> Dict[str, Dict[tuple, float]]:
+        with self.lock:
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, callback in list(self.gauge_callbacks.items()):
+            try:
+                gauges[name] = {(): float(callback())}
+            except Exception as e:
+                print(f"Error reading gauge {name}. Details {e}")
+        return gauges
+
+    def render(self) -> str:
+        # Prometheus text exposition format.
+        lines = []
+        gauges = self.collect_gauges()
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{PREFIX}_{name}{format_labels(labels)} {value}")
+            for name, series in sorted(gauges.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{PREFIX}_{name}{format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(BUCKETS, histogram.buckets):
+                        bucket = format_labels(labels + (("le", str(bound)),))
+                        lines.append(f"{PREFIX}_{name}_bucket{bucket} {count}")
+                    bucket = format_labels(labels + (("le", "+Inf"),))
+                    lines.append(f"{PREFIX}_{name}_bucket{bucket} {histogram.count}")
+                    lines.append(f"{PREFIX}_{name}_sum{format_labels(labels)} {histogram.total}")
+                    lines.append(f"{PREFIX}_{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def counter_total(self, name: str, **labels) -> float:
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(
+                value for key, value in self.counters.get(name, {}).items() if wanted <= set(key)
+            )
+
+    def span_summary(self) -> List[Tuple[str, int, float, float, float]]:
+        with self.lock:
+            return [
+                (dict(labels)["span"], histogram.count, histogram.total,
+                 histogram.quantile(0.5), histogram.quantile(0.95))
+                for labels, histogram in sorted(self.histograms.get("span_seconds", {}).items())
+            ]
+
+    def cache_summary(self) -> Dict[str, Tuple[float, float]]:
+        caches: Dict[str, List[float]] = {}
+        with self.lock:
+            for labels, value in self.counters.get("cache_requests_total", {}).items():
+                labels = dict(labels)
+                counts = caches.setdefault(labels["cache"], [0.0, 0.0])
+                counts[labels["result"] == "miss"] += value
+        return {name: (hits, misses) for name, (hits, misses) in caches.items()}
+
+    async def start_server(self, host: str = "127.0.0.1", port: int = 9464) -> web.AppRunner:
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+class LLMUsageHandler(BaseCallbackHandler):
+    # Counts calls, tokens, cost and latency per model. Streamed calls get
+    # no token_usage from OpenAI, their tokens are counted locally.
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+        self.runs: Dict[object, dict] = {}
+        self.encoders: Dict[str, tiktoken.Encoding | None] = {}
+
+    def start_run(self, run_id, serialized: dict, prompt: str, kwargs: dict) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = (
+            params.get("model_name") or params.get("model")
+            or (serialized or {}).get("kwargs", {}).get("model_name") or "unknown"
+        )
+        self.runs[run_id] = {"model": model, "prompt": prompt, "tokens": 0, "start": time.perf_counter()}
+
+    def on_llm_start(self, serialized: dict, prompts: List[str], *, run_id, **kwargs) -> None:
+        self.start_run(run_id, serialized, "\n".join(prompts), kwargs)
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id, **kwargs) -> None:
+        prompt = "\n".join(message.content for batch in messages for message in batch)
+        self.start_run(run_id, serialized, prompt, kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs) -> None:
+        if run_id in self.runs:
+            self.runs[run_id]["tokens"] += 1
+
+    def count_tokens(self, model: str, text: str) -> int:
+        if model not in self.encoders:
+            try:
+                self.encoders[model] = tiktoken.encoding_for_model(model)
+            except Exception:
+                self.encoders[model] = None
+        encoder = self.encoders[model]
+        return len(encoder.encode(text, disallowed_special=())) if encoder else len(text) // 4
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        output = response.llm_output or {}
+        model = output.get("model_name") or run["model"]
+        usage = output.get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens") or self.count_tokens(model, run["prompt"])
+        completion_tokens = usage.get("completion_tokens") or run["tokens"]
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+
+        self.metrics.inc("llm_requests_total", model=model)
+        self.metrics.inc("llm_tokens_total", prompt_tokens, model=model, kind="prompt")
+        self.metrics.inc("llm_tokens_total", completion_tokens, model=model, kind="completion")
+        self.metrics.inc(
+            "llm_cost_usd_total",
+            (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000,
+            model=model,
+        )
+        self.metrics.observe("llm_request_seconds", time.perf_counter() - run["start"], model=model)
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs) -> None:
+        run = self.runs.pop(run_id, None)
+        self.metrics.inc("llm_errors_total", model=run["model"] if run else "unknown")
+
+
+class SamplingProfiler:
+    # Samples the stack of every thread each `interval` seconds and writes
+    # them in the folded format flamegraph.pl and speedscope read.
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wt") as fp:
+            for stack, count in self.samples.most_common():
+                fp.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profile(path: str, interval: float = 0.005) -> Iterator[SamplingProfiler]:
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.write(path)
+
+
+metrics = Metrics()
+llm_usage = LLMUsageHandler(metrics)
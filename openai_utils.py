@@ -1,27 +1,93 @@
-from langchain.document_loaders import PyPDFLoader
+from langchain.embeddings.base import Embeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.vectorstores import Pinecone
 from langchain.llms import OpenAI
-from langchain.chains.summarize import load_summarize_chain
-from langchain.text_splitter import CharacterTextSplitter
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import ConversationalRetrievalChain
 from data_storage import ChatManager
 from langchain.chains import LLMChain
-from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
-from globals import creds, config
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.prompts import PromptTemplate
+from langchain.schema import SystemMessage
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.vectorstores.base import VectorStore
+from globals import creds, config, db
+from embeddings import get_embeddings
+from vector_stores import InMemoryVectorStore, LocalANNVectorStore
+from upsert_pipeline import UpsertPipeline
+from pdf_extraction import PDFExtractor
+from summarization import SummaryEngine
+from answer_cache import AnswerCache
+from hybrid_retrieval import CrossEncoderReranker, HybridRetriever, KeywordIndex
+from metrics import llm_usage, metrics
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable
+import aiohttp
+import asyncio
 import hashlib
+import openai
+import os
+import pinecone
+import threading
+import time
+import weakref
+
+CORPUS_NAMESPACE = "corpus"
+ABSTRACT_PROMPT = PromptTemplate.from_template(
+    "Summarize this arXiv paper for a research chat channel in two or three "
+    "plain sentences: what problem it tackles, what it proposes and what it "
+    "finds.\n\nTitle: {title}\n\nAbstract: {abstract}\n\nSUMMARY:"
+)
+
+pdf_extractor = PDFExtractor(
+    config.get("PDF_TEXT_CACHE_DIR", "cache/pdf_text"),
+    chunk_size=config.get("CHUNK_SIZE", 1000),
+    workers=config.get("EXTRACTION_WORKERS", 2),
+)
+
+answer_cache = AnswerCache(
+    threshold=config.get("ANSWER_CACHE_THRESHOLD", 0.95),
+    ttl=config.get("ANSWER_CACHE_TTL", 24 * 60 * 60),
+    max_entries=config.get("ANSWER_CACHE_SIZE", 2000),
+)
+# Every ChatSessionManager, so re-ingesting a paper can drop its sessions.
+session_managers = weakref.WeakSet()
+
+summary_engine = None
+summary_engine_lock = threading.Lock()
+
+
+def get_summary_engine() -> SummaryEngine:
+    global summary_engine
+    with summary_engine_lock:
+        if summary_engine is None:
+            llm = ChatOpenAI(
+                temperature=0,
+                openai_api_key=creds["OPENAI_API_KEY"],
+                model_name=config["MODEL_NAME"],
+                callbacks=[llm_usage],
+            )
+            summary_engine = SummaryEngine(
+                llm,
+                db,
+                max_concurrency=config.get("SUMMARY_CONCURRENCY", 4),
+                requests_per_minute=config.get("SUMMARY_REQUESTS_PER_MINUTE", 0),
+            )
+    return summary_engine
+
 
 def summarize_pdf(docs) -> str:
-    llm = ChatOpenAI(
-        temperature=0,
-        openai_api_key=creds["OPENAI_API_KEY"],
-        model_name=config["MODEL_NAME"],
-    )
-    chain = load_summarize_chain(llm, chain_type="map_reduce", verbose=True)
-    return chain.run(docs)
+    return get_summary_engine().summarize(docs)
+
+
+def summarize_abstract(title: str, abstract: str) -> str:
+    if not abstract:
+        return ""
+    llm = get_summary_engine().llm
+    return llm.predict(ABSTRACT_PROMPT.format(title=title.replace("-", " "), abstract=abstract)).strip()
 
 
 def generate_unique_string(input_string: str, length: int) -> str:
@@ -29,61 +95,488 @@ def generate_unique_string(input_string: str, length: int) -> str:
     return hashed_string[:length]
 
 
-def add_pdf_to_memory(filepath: str) -> str:
-    loader = PyPDFLoader(filepath)
-    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=1000, chunk_overlap=0
+def load_pdf_pages(filepath: str) -> list:
+    return pdf_extractor.load(filepath)
+
+
+def pdf_metadata(filepath: str, link: str = "", category: str = "") -> dict:
+    # Scraped files are named <arxiv id>__<d-m-yy>__<title>.pdf, anything
+    # else only yields an id and a title.
+    name = os.path.basename(filepath)
+    parts = (name[:-4] if name.endswith(".pdf") else name).split("__")
+    metadata = {
+        "arxiv_id": parts[0],
+        "title": parts[-1],
+        "category": category,
+        "link": link,
+    }
+    if len(parts) >= 3:
+        try:
+            metadata["published"] = int(datetime.strptime(parts[1], "%d-%m-%y").strftime("%Y%m%d"))
+        except ValueError:
+            pass
+    return metadata
+
+
+shared_store = None
+corpus_store = None
+store_lock = threading.Lock()
+
+
+pinecone_indexes: dict[str, pinecone.Index] = {}
+pinecone_index_lock = threading.Lock()
+aiosession = None
+
+
+def get_pinecone_index(index_name: str) -> pinecone.Index:
+    # One client per index, so every namespace shares its connection pool.
+    with pinecone_index_lock:
+        if index_name not in pinecone_indexes:
+            pinecone_indexes[index_name] = pinecone.Index(
+                index_name, pool_threads=config.get("PINECONE_POOL_THREADS", 8)
+            )
+        return pinecone_indexes[index_name]
+
+
+def use_shared_aiosession() -> None:
+    # openai<1.0 keeps its aiohttp session in a ContextVar, without one every
+    # acreate opens and closes a session of its own.
+    global aiosession
+    if aiosession is None or aiosession.closed:
+        aiosession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.get("OPENAI_MAX_CONNECTIONS", 32))
+        )
+    if openai.aiosession.get() is None:
+        openai.aiosession.set(aiosession)
+
+
+async def close_shared_aiosession() -> None:
+    if aiosession is not None and not aiosession.closed:
+        await aiosession.close()
+
+
+def get_vector_store(namespace: str, embeddings: Embeddings | None = None, index_name: str | None = None) -> VectorStore:
+    # VECTOR_STORE picks the backend: "pinecone" (default), "local" for the
+    # on-disk ANN index under VECTOR_STORE_DIR, or "memory".
+    global shared_store
+    backend = config.get("VECTOR_STORE", "pinecone")
+    embeddings = embeddings or get_embeddings()
+    if backend == "pinecone":
+        return Pinecone(
+            get_pinecone_index(index_name or creds["INDEX_NAME"]), embeddings, "text", namespace=namespace
+        )
+
+    with store_lock:
+        if shared_store is None:
+            if backend == "local":
+                shared_store = LocalANNVectorStore(
+                    config.get("VECTOR_STORE_DIR", "cache/vector_store"), embeddings
+                )
+            elif backend == "memory":
+                shared_store = InMemoryVectorStore(embeddings)
+            else:
+                raise ValueError(f"Unknown VECTOR_STORE {backend}")
+    return shared_store.scoped(namespace)
+
+
+def get_corpus_store() -> VectorStore:
+    global corpus_store
+    if corpus_store is None:
+        corpus_store = get_vector_store(CORPUS_NAMESPACE)
+    return corpus_store
+
+
+keyword_index = None
+reranker = None
+
+
+def get_keyword_index() -> KeywordIndex:
+    global keyword_index
+    with store_lock:
+        if keyword_index is None:
+            path = config.get("KEYWORD_INDEX_PATH", "cache/keywords.db")
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            keyword_index = KeywordIndex(path)
+    return keyword_index
+
+
+def get_reranker() -> CrossEncoderReranker | None:
+    # Reranking is off unless RERANK_MODEL names a cross-encoder.
+    global reranker
+    if reranker is None and config.get("RERANK_MODEL"):
+        reranker = CrossEncoderReranker(config["RERANK_MODEL"])
+    return reranker
+
+
+upsert_pipeline = None
+
+
+def get_upsert_pipeline() -> UpsertPipeline:
+    global upsert_pipeline
+    with store_lock:
+        if upsert_pipeline is None:
+            upsert_pipeline = UpsertPipeline(
+                get_pinecone_index(creds["INDEX_NAME"]),
+                get_embeddings(),
+                db,
+                batch_size=config.get("UPSERT_BATCH_SIZE", 100),
+                max_concurrency=config.get("UPSERT_CONCURRENCY", 4),
+            )
+    return upsert_pipeline
+
+
+def upsert_pages(
+    namespace: str,
+    pages: list,
+    ids: list[str],
+    metadata: dict | None = None,
+    vectors: list | None = None,
+) -> None:
+    # `vectors` is shared between the paper's namespace and the corpus, so
+    # each chunk is embedded once.
+    texts = [page.page_content for page in pages]
+    metadatas = [{**page.metadata, **(metadata or {})} for page in pages]
+    if config.get("VECTOR_STORE", "pinecone") == "pinecone":
+        get_upsert_pipeline().upsert(namespace, texts, metadatas, ids, vectors)
+        return
+    if vectors is not None and any(vector is None for vector in vectors):
+        vectors[:] = get_embeddings().embed_documents(texts)
+    with metrics.span("upsert"):
+        get_vector_store(namespace).add_texts(texts, metadatas=metadatas, ids=ids, vectors=vectors)
+
+
+def add_pages_to_corpus(pages: list, metadata: dict, vectors: list | None = None) -> None:
+    # Ids are stable per paper, so re-ingesting overwrites instead of
+    # duplicating chunks.
+    paper_key = generate_unique_string(metadata.get("arxiv_id", ""), 12)
+    upsert_pages(
+        CORPUS_NAMESPACE, pages, [f"{paper_key}-{i}" for i in range(len(pages))], metadata, vectors
     )
-    pages = loader.load_and_split(text_splitter=text_splitter)
+
+
+def store_pdf_pages(filepath: str, pages: list, metadata: dict | None = None) -> str:
     namespace = f"{generate_unique_string(filepath, 7)}__{filepath}"
-    Pinecone.from_documents(
-        pages,
-        HuggingFaceEmbeddings(),
-        index_name=creds["INDEX_NAME"],
-        namespace=namespace,
+    ids = [f"chunk-{i}" for i in range(len(pages))]
+    vectors = [None] * len(pages)
+    upsert_pages(namespace, pages, ids, vectors=vectors)
+    get_keyword_index().add(
+        namespace, ids, [page.page_content for page in pages], [page.metadata for page in pages]
     )
+    answer_cache.invalidate(namespace)
+    for session_manager in list(session_managers):
+        session_manager.invalidate(namespace)
+    add_pages_to_corpus(pages, metadata or pdf_metadata(filepath), vectors)
+    return namespace
+
+
+def add_pdf_to_memory(filepath: str, metadata: dict | None = None) -> str:
+    pages = load_pdf_pages(filepath)
+    namespace = store_pdf_pages(filepath, pages, metadata)
     return namespace, pages
 
 
+def parse_corpus_filter(words: list[str]) -> tuple[str, dict]:
+    question, conditions = [], []
+    for word in words:
+        key, _, value = word.partition(":")
+        if not value or key not in ("category", "paper", "since", "until"):
+            question.append(word)
+        elif key == "category":
+            conditions.append({"category": {"$eq": value}})
+        elif key == "paper":
+            conditions.append({"arxiv_id": {"$eq": value}})
+        elif value.replace("-", "").isdigit():
+            day = int(value.replace("-", ""))
+            conditions.append({"published": {"$gte" if key == "since" else "$lte": day}})
+        else:
+            question.append(word)
+    if not conditions:
+        return " ".join(question), {}
+    return " ".join(question), conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+class CorpusRetrieval:
+    def __init__(self, vectorstore: VectorStore, llm: ChatOpenAI, k: int = 8, max_per_paper: int = 3) -> None:
+        self.vectorstore = vectorstore
+        self.llm = llm
+        self.k = k
+        self.max_per_paper = max_per_paper
+        self.qa_chain = load_qa_chain(llm, chain_type="stuff")
+
+    def search(self, question: str, filter: dict | None = None) -> list:
+        return self.vectorstore.similarity_search_with_score(
+            question, k=self.k, filter=filter or None, namespace=CORPUS_NAMESPACE
+        )
+
+    def group_by_paper(self, results: list) -> list[dict]:
+        groups = {}
+        for document, score in results:
+            metadata = document.metadata
+            group = groups.setdefault(
+                metadata.get("arxiv_id", metadata.get("source", "")),
+                {
+                    "arxiv_id": metadata.get("arxiv_id", ""),
+                    "title": metadata.get("title", ""),
+                    "link": metadata.get("link", ""),
+                    "score": score,
+                    "pages": [],
+                    "documents": [],
+                },
+            )
+            group["score"] = max(group["score"], score)
+            if len(group["documents"]) < self.max_per_paper:
+                group["documents"].append(document)
+                group["pages"].append(metadata.get("page"))
+        return sorted(groups.values(), key=lambda group: group["score"], reverse=True)
+
+    def ask(self, question: str, filter: dict | None = None) -> tuple[str, list[dict]]:
+        groups = self.group_by_paper(self.search(question, filter))
+        documents = [document for group in groups for document in group["documents"]]
+        if not documents:
+            return "No papers in the knowledge base match that question.", []
+        answer = self.qa_chain.run(input_documents=documents, question=question)
+        return answer, groups
+
+
+class TextStreamHandler(AsyncCallbackHandler):
+    # Hands the answer generated so far to the callback. The text restarts
+    # with every LLM run, so only the last one (the answer) is left at the end.
+    def __init__(self, callback: Callable[[str], Awaitable[None]]) -> None:
+        self.callback = callback
+        self.text = ""
+
+    async def on_llm_start(self, *args, **kwargs) -> None:
+        self.text = ""
+
+    async def on_chat_model_start(self, *args, **kwargs) -> None:
+        self.text = ""
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.text += token
+        await self.callback(self.text)
 
 
 class ChatRetrievalWithDB:
-    def __init__(self, namespace: str, index_name: str, embeddings: OpenAIEmbeddings, llm: OpenAI, chat_manager: ChatManager) -> None:
+    def __init__(
+        self,
+        namespace: str,
+        index_name: str,
+        embeddings: OpenAIEmbeddings,
+        llm: OpenAI,
+        chat_manager: ChatManager,
+        session: str = "",
+        max_turns: int = 6,
+        max_history_tokens: int = 1500,
+        condense_llm: ChatOpenAI | None = None,
+        vectorstore: VectorStore | None = None,
+        answer_cache: AnswerCache | None = None,
+    ) -> None:
         self.namespace = namespace
         self.index_name = index_name
         self.embeddings = embeddings
         self.llm = llm
+        self.condense_llm = condense_llm
+        self.answer_cache = answer_cache
         self.chat_manager = chat_manager
+        self.session = session
+        self.max_turns = max_turns
+        self.max_history_tokens = max_history_tokens
+        self.chat_history = None
+        self.summary = ""
+        self.summary_sequence_number = -1
+        self.last_used = time.monotonic()
+        self.chat_lock = asyncio.Lock()
         
-        self.qa = self.make_chain(self.get_vector_store())
+        self.qa = self.make_chain(vectorstore or self.get_vector_store())
         
-    def get_vector_store(self) -> Pinecone | None:
+    def get_vector_store(self) -> VectorStore | None:
         try:
-            return Pinecone.from_existing_index(
-                self.index_name,
-                self.embeddings,
-                namespace=self.namespace,
-            )
+            return get_vector_store(self.namespace, self.embeddings, self.index_name)
         except Exception as e:
             print(e)
 
-    def make_chain(self, vectorstore: Pinecone):
+    def make_retriever(self, vectorstore: VectorStore):
+        # RETRIEVAL "hybrid" fuses BM25 over the paper's chunks with the
+        # vector results, "vector" is dense top-k only.
+        if config.get("RETRIEVAL", "hybrid") != "hybrid":
+            return vectorstore.as_retriever(search_kwargs={"k": config.get("RETRIEVAL_K", 4)})
+        return HybridRetriever(
+            vectorstore=vectorstore,
+            keyword_index=get_keyword_index(),
+            namespace=self.namespace,
+            k=config.get("RETRIEVAL_K", 4),
+            fetch_k=config.get("RETRIEVAL_FETCH_K", 20),
+            rrf_k=config.get("RRF_K", 2),
+            dense_weight=config.get("RETRIEVAL_DENSE_WEIGHT", 0.3),
+            reranker=get_reranker(),
+            rerank_candidates=config.get("RERANK_CANDIDATES", 12),
+        )
+
+    def make_chain(self, vectorstore: VectorStore):
         return ConversationalRetrievalChain.from_llm(
-            retriever=vectorstore.as_retriever(),
+            retriever=self.make_retriever(vectorstore),
             llm=self.llm,
+            condense_question_llm=self.condense_llm,
             return_source_documents=True,
         )
 
+    def load_chat_history(self) -> None:
+        self.summary, self.summary_sequence_number = self.chat_manager.get_summary(
+            self.namespace, self.session
+        )
+        self.chat_history = self.chat_manager.retrieve_recent_messages(
+            self.namespace,
+            self.session,
+            limit=self.max_turns * 2,
+            after_sequence_number=self.summary_sequence_number,
+        )
+
+    def count_tokens(self, turns: list) -> int:
+        return sum(self.llm.get_num_tokens(f"{human}\n{ai}") for _, human, ai in turns)
+
+    def compact_chat_history(self) -> None:
+        # Turns that fall outside the window or the token budget are folded
+        # into a rolling summary, so the condense step sees a bounded prompt
+        # however long the conversation gets.
+        # Compaction trims down to half the window so the summary LLM call
+        # happens every few turns rather than on every one.
+        if (
+            len(self.chat_history) <= self.max_turns
+            and self.count_tokens(self.chat_history) <= self.max_history_tokens
+        ):
+            return
+        overflow = []
+        while self.chat_history and (
+            len(self.chat_history) > max(1, self.max_turns // 2)
+            or self.count_tokens(self.chat_history) > self.max_history_tokens
+        ):
+            overflow.append(self.chat_history.pop(0))
+
+        new_lines = "\n".join(f"Human: {human}\nAI: {ai}" for _, human, ai in overflow)
+        self.summary = LLMChain(llm=self.condense_llm or self.llm, prompt=SUMMARY_PROMPT).predict(
+            summary=self.summary, new_lines=new_lines
+        )
+        self.summary_sequence_number = overflow[-1][0]
+        self.chat_manager.save_summary(
+            self.namespace, self.summary, self.summary_sequence_number, self.session
+        )
+
     def get_chat_history(self):
-        return self.chat_manager.retrieve_all_messages(self.namespace)
+        if self.chat_history is None:
+            self.load_chat_history()
+        self.compact_chat_history()
+        history = [SystemMessage(content=self.summary)] if self.summary else []
+        return history + [(human, ai) for _, human, ai in self.chat_history]
         
     def add_message_to_db(self, ai_message: str, human_message: str) -> None:
-        self.chat_manager.add_message(self.namespace, ai_message, human_message)
+        sequence_number = self.chat_manager.add_message(
+            self.namespace, ai_message, human_message, self.session
+        )
+        if self.chat_history is not None:
+            self.chat_history.append((sequence_number, human_message, ai_message))
         
+    def lookup_answer(self, message: str, chat_history: list) -> tuple:
+        # Only a question that opens a conversation can reuse an answer,
+        # later ones depend on what was said before.
+        if self.answer_cache is None or chat_history:
+            return None, None
+        return self.answer_cache.get(self.namespace, message, self.embeddings)
+
+    def cache_answer(self, cache_key: tuple | None, answer: str, started_at: float) -> None:
+        if cache_key is not None:
+            self.answer_cache.put(self.namespace, cache_key, answer, time.perf_counter() - started_at)
+
     def chat(self, message: str) -> str:
-        print(message)
-        result = self.qa({"question": message, "chat_history": self.get_chat_history()})
-        output = result['answer']
-        print(result['source_documents'])
-        self.add_message_to_db(output, human_message=message)
+        with metrics.span("chat"):
+            started_at = time.perf_counter()
+            chat_history = self.get_chat_history()
+            output, cache_key = self.lookup_answer(message, chat_history)
+            if output is None:
+                result = self.qa({"question": message, "chat_history": chat_history})
+                output = result['answer']
+                metrics.inc("chat_source_documents_total", len(result['source_documents']))
+                self.cache_answer(cache_key, output, started_at)
+            self.add_message_to_db(output, human_message=message)
         return output
+
+    async def achat(self, message: str, on_text: Callable[[str], Awaitable[None]] | None = None) -> str:
+        # Turns of one session run one at a time so each sees the previous
+        # answer, different sessions run concurrently.
+        use_shared_aiosession()
+        loop = asyncio.get_running_loop()
+        with metrics.span("chat"):
+            async with self.chat_lock:
+                started_at = time.perf_counter()
+                chat_history = await loop.run_in_executor(None, self.get_chat_history)
+                output, cache_key = await loop.run_in_executor(
+                    None, self.lookup_answer, message, chat_history
+                )
+                if output is None:
+                    callbacks = [TextStreamHandler(on_text)] if on_text is not None else []
+                    result = await self.qa.acall(
+                        {"question": message, "chat_history": chat_history}, callbacks=callbacks
+                    )
+                    output = result["answer"]
+                    metrics.inc("chat_source_documents_total", len(result["source_documents"]))
+                    self.cache_answer(cache_key, output, started_at)
+                await loop.run_in_executor(None, self.add_message_to_db, output, message)
+        return output
+
+
+class ChatSessionManager:
+    def __init__(
+        self,
+        index_name: str,
+        embeddings: Embeddings,
+        llm: ChatOpenAI,
+        chat_manager: ChatManager,
+        max_sessions: int = 32,
+        idle_ttl: float = 30 * 60,
+        condense_llm: ChatOpenAI | None = None,
+        answer_cache: AnswerCache | None = None,
+    ) -> None:
+        self.index_name = index_name
+        self.embeddings = embeddings
+        self.llm = llm
+        self.condense_llm = condense_llm
+        self.answer_cache = answer_cache
+        self.chat_manager = chat_manager
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions: OrderedDict[tuple[str, str], ChatRetrievalWithDB] = OrderedDict()
+        self.lock = threading.Lock()
+        session_managers.add(self)
+
+    def get(self, namespace: str, session_key: str = "") -> ChatRetrievalWithDB:
+        with self.lock:
+            now = time.monotonic()
+            self.evict_idle(now)
+            session = self.sessions.pop((namespace, session_key), None)
+            if session is None:
+                session = ChatRetrievalWithDB(
+                    namespace,
+                    self.index_name,
+                    self.embeddings,
+                    self.llm,
+                    self.chat_manager,
+                    session=session_key,
+                    condense_llm=self.condense_llm,
+                    answer_cache=self.answer_cache,
+                )
+            session.last_used = now
+            self.sessions[(namespace, session_key)] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def evict_idle(self, now: float) -> None:
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if now - session.last_used < self.idle_ttl:
+                return
+            del self.sessions[key]
+
+    def invalidate(self, namespace: str) -> None:
+        with self.lock:
+            for key in [key for key in self.sessions if key[0] == namespace]:
+                del self.sessions[key]
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import tiktoken
+from langchain.docstore.document import Document
+from langchain.text_splitter import CharacterTextSplitter
+from pypdf import PdfReader
+
+from metrics import metrics
+
+encoders: Dict[str, tiktoken.Encoding] = {}
+
+
+def get_encoder(encoding_name: str) -> tiktoken.Encoding:
+    if encoding_name not in encoders:
+        encoders[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return encoders[encoding_name]
+
+
+def file_hash(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_page_range(filepath: str, start: int, end: int) -> List[str]:
+    # Runs in a worker process, each worker opens its own reader.
+    reader = PdfReader(filepath)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+
+class PDFExtractor:
+    def __init__(
+        self,
+        cache_dir: str,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 0,
+        encoding_name: str = "gpt2",
+        workers: int = 2,
+        pages_per_task: int = 8,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.encoding_name = encoding_name
+        self.workers = workers
+        self.pages_per_task = pages_per_task
+        self.pool = None
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                # The bot already runs threads here, forking them is unsafe.
+                self.pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.pool
+
+    def cache_path(self, pdf_hash: str, name: str) -> str:
+        return os.path.join(self.cache_dir, pdf_hash[:2], pdf_hash, name)
+
+    def read_cache(self, path: str):
+        try:
+            with open(path, "rt") as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_cache(self, path: str, data) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "wt") as fp:
+            json.dump(data, fp)
+        os.replace(tmp_file, path)
+
+    def extract_pages(self, filepath: str, pdf_hash: str | None = None) -> List[str]:
+        pdf_hash = pdf_hash or file_hash(filepath)
+        path = self.cache_path(pdf_hash, "pages.json")
+        pages = self.read_cache(path)
+        metrics.cache("pdf_text", hits=pages is not None, misses=pages is None)
+        if pages is not None:
+            return pages
+
+        with metrics.span("extract"):
+            pages = self.extract_all(filepath)
+        self.write_cache(path, pages)
+        return pages
+
+    def extract_all(self, filepath: str) -> List[str]:
+        page_count = len(PdfReader(filepath).pages)
+        ranges = [
+            (start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ]
+        if len(ranges) <= 1 or self.workers <= 1:
+            pages = extract_page_range(filepath, 0, page_count)
+        else:
+            pool = self.get_pool()
+            futures = [pool.submit(extract_page_range, filepath, start, end) for start, end in ranges]
+            pages = [text for future in futures for text in future.result()]
+        return pages
+
+    def make_splitter(self, pages: List[str], chunk_size: int) -> CharacterTextSplitter:
+        # Measure every piece the splitter will look at in one encode_batch
+        # call, the splitter then only does dictionary lookups. Special
+        # tokens such as <|endoftext|> in a paper count as plain text, the
+        # old from_tiktoken_encoder path raised on them.
+        encoder = get_encoder(self.encoding_name)
+        pieces = {"\n\n"}
+        for text in pages:
+            pieces.update(piece for piece in text.split("\n\n") if piece)
+        pieces = list(pieces)
+        lengths = dict(zip(pieces, map(len, encoder.encode_batch(pieces, disallowed_special=()))))
+
+        def length_function(text: str) -> int:
+            if text not in lengths:
+                lengths[text] = len(encoder.encode(text, disallowed_special=()))
+            return lengths[text]
+
+        return CharacterTextSplitter(
+            separator="\n\n",
+            chunk_size=chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            length_function=length_function,
+        )
+
+    def chunk_boundaries(self, pages: List[str], chunk_size: int) -> list:
+        # Chunks are stored as [page, start, end] offsets into the page
+        # text, or [page, text] when the splitter changed the whitespace.
+        splitter = self.make_splitter(pages, chunk_size)
+        boundaries = []
+        for page_number, text in enumerate(pages):
+            offset = 0
+            for chunk in splitter.split_text(text):
+                start = text.find(chunk, offset)
+                if start == -1:
+                    boundaries.append([page_number, chunk])
+                    continue
+                offset = start + len(chunk)
+                boundaries.append([page_number, start, offset])
+        return boundaries
+
+    def load(self, filepath: str, chunk_size: int | None = None) -> List[Document]:
+        chunk_size = chunk_size or self.chunk_size
+        pdf_hash = file_hash(filepath)
+        pages = self.extract_pages(filepath, pdf_hash)
+
+        path = self.cache_path(
+            pdf_hash, f"chunks-{self.encoding_name}-{chunk_size}-{self.chunk_overlap}.json"
+        )
+        boundaries = self.read_cache(path)
+        metrics.cache("pdf_chunks", hits=boundaries is not None, misses=boundaries is None)
+        if boundaries is None:
+            with metrics.span("chunk"):
+                boundaries = self.chunk_boundaries(pages, chunk_size)
+            self.write_cache(path, boundaries)
+
+        documents = []
+        for boundary in boundaries:
+            page_number = boundary[0]
+            text = boundary[1] if len(boundary) == 2 else pages[page_number][boundary[1]:boundary[2]]
+            documents.append(
+                Document(page_content=text, metadata={"source": filepath, "page": page_number})
+            )
+        return documents
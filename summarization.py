@@ -0,0 +1,223 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from langchain.chains.summarize import map_reduce_prompt
+from langchain.prompts.base import StringPromptValue
+from langchain.schema.language_model import BaseLanguageModel
+from peewee import CharField, Model, SqliteDatabase, TextField, chunked
+
+from metrics import metrics
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float) -> None:
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SummaryStats:
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.wall_time = 0.0
+        self.chunks = 0
+        self.cached_chunks = 0
+        self.llm_calls = 0
+        self.reduce_rounds = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_document = False
+        self.lock = threading.Lock()
+
+    def record_call(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self.lock:
+            self.llm_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def finish(self) -> "SummaryStats":
+        self.wall_time = time.perf_counter() - self.started_at
+        return self
+
+    def describe(self) -> str:
+        if self.cached_document:
+            return f"cached summary in {self.wall_time:.2f}s"
+        return (
+            f"{self.chunks} chunks ({self.cached_chunks} cached), {self.llm_calls} LLM calls, "
+            f"{self.reduce_rounds} reduce rounds, {self.prompt_tokens}+{self.completion_tokens} "
+            f"tokens in {self.wall_time:.2f}s"
+        )
+
+
+class SummaryEngine:
+    def __init__(
+        self,
+        llm: BaseLanguageModel,
+        db: SqliteDatabase,
+        max_concurrency: int = 4,
+        requests_per_minute: float = 0,
+        max_reduce_tokens: int = 3000,
+        map_prompt=map_reduce_prompt.PROMPT,
+        combine_prompt=map_reduce_prompt.PROMPT,
+    ) -> None:
+        self.llm = llm
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.max_reduce_tokens = max_reduce_tokens
+        self.map_prompt = map_prompt
+        self.combine_prompt = combine_prompt
+        self.pool = ThreadPoolExecutor(max_concurrency)
+
+        class ChunkSummary(Model):
+            chunk_hash = CharField(primary_key=True)
+            summary = TextField()
+
+            class Meta:
+                database = db
+
+        class DocumentSummary(Model):
+            document_hash = CharField(primary_key=True)
+            summary = TextField()
+
+            class Meta:
+                database = db
+
+        self.db = db
+        self.chunk_model = ChunkSummary
+        self.document_model = DocumentSummary
+        db.create_tables([ChunkSummary, DocumentSummary], safe=True)
+
+    @property
+    def model_id(self) -> str:
+        return getattr(self.llm, "model_name", None) or type(self.llm).__name__
+
+    def hash(self, *parts: str) -> str:
+        # The model and both prompts are part of every key, so switching
+        # any of them starts a fresh cache.
+        digest = hashlib.sha256()
+        for part in (self.model_id, self.map_prompt.template, self.combine_prompt.template, *parts):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm.get_num_tokens(text)
+
+    def call(self, prompt: str, stats: SummaryStats) -> str:
+        self.rate_limiter.wait()
+        result = self.llm.generate_prompt([StringPromptValue(text=prompt)])
+        text = result.generations[0][0].text.strip()
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        stats.record_call(
+            usage.get("prompt_tokens") or self.count_tokens(prompt),
+            usage.get("completion_tokens") or self.count_tokens(text),
+        )
+        return text
+
+    def map_chunks(self, chunks: List[str], stats: SummaryStats) -> List[str]:
+        hashes = [self.hash("map", chunk) for chunk in chunks]
+        cached = {
+            chunk_hash: summary
+            for chunk_hash, summary in self.chunk_model.select(
+                self.chunk_model.chunk_hash, self.chunk_model.summary
+            )
+            .where(self.chunk_model.chunk_hash.in_(list(set(hashes))))
+            .tuples()
+        }
+        stats.chunks = len(chunks)
+        stats.cached_chunks = sum(chunk_hash in cached for chunk_hash in hashes)
+        metrics.cache("chunk_summary", hits=stats.cached_chunks, misses=stats.chunks - stats.cached_chunks)
+
+        missing = {}
+        for chunk_hash, chunk in zip(hashes, chunks):
+            if chunk_hash not in cached:
+                missing.setdefault(chunk_hash, chunk)
+        summaries = self.pool.map(
+            lambda chunk: self.call(self.map_prompt.format(text=chunk), stats), missing.values()
+        )
+        computed = dict(zip(missing, summaries))
+        if computed:
+            with self.db.atomic():
+                for batch in chunked(list(computed.items()), 100):
+                    self.chunk_model.insert_many(
+                        batch, fields=[self.chunk_model.chunk_hash, self.chunk_model.summary]
+                    ).on_conflict_replace().execute()
+        cached.update(computed)
+        return [cached[chunk_hash] for chunk_hash in hashes]
+
+    def pack(self, summaries: List[str]) -> List[List[str]]:
+        # Greedily fill each group up to the token budget, so every round
+        # shrinks the input as much as one prompt allows.
+        groups, group, tokens = [], [], 0
+        for summary in summaries:
+            summary_tokens = self.count_tokens(summary)
+            if group and tokens + summary_tokens > self.max_reduce_tokens:
+                groups.append(group)
+                group, tokens = [], 0
+            group.append(summary)
+            tokens += summary_tokens
+        if group:
+            groups.append(group)
+        return groups
+
+    def reduce(self, summaries: List[str], stats: SummaryStats) -> str:
+        groups = self.pack(summaries)
+        while len(groups) > 1:
+            stats.reduce_rounds += 1
+            summaries = list(
+                self.pool.map(
+                    lambda group: self.call(
+                        self.combine_prompt.format(text="\n\n".join(group)), stats
+                    ),
+                    groups,
+                )
+            )
+            packed = self.pack(summaries)
+            if len(packed) >= len(groups):
+                # The summaries stopped shrinking, combine what is left.
+                groups = [summaries]
+                break
+            groups = packed
+        stats.reduce_rounds += 1
+        return self.call(self.combine_prompt.format(text="\n\n".join(groups[0])), stats)
+
+    def summarize_with_stats(self, docs: list) -> Tuple[str, SummaryStats]:
+        with metrics.span("summarize"):
+            return self.summarize_documents(docs)
+
+    def summarize_documents(self, docs: list) -> Tuple[str, SummaryStats]:
+        stats = SummaryStats()
+        chunks = [doc.page_content for doc in docs]
+        if not chunks:
+            return "", stats.finish()
+        document_hash = self.hash("document", *chunks)
+        cached = self.document_model.get_or_none(self.document_model.document_hash == document_hash)
+        metrics.cache("document_summary", hits=cached is not None, misses=cached is None)
+        if cached is not None:
+            stats.cached_document = True
+            return cached.summary, stats.finish()
+
+        summary = self.reduce(self.map_chunks(chunks, stats), stats)
+        self.document_model.insert(
+            document_hash=document_hash, summary=summary
+        ).on_conflict_replace().execute()
+        metrics.inc("summary_llm_calls_total", stats.llm_calls)
+        metrics.inc("summary_reduce_rounds_total", stats.reduce_rounds)
+        return summary, stats.finish()
+
+    def summarize(self, docs: list) -> str:
+        summary, _ = self.summarize_with_stats(docs)
+        return summary
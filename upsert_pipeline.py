@@ -0,0 +1,197 @@
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterator, List
+
+from langchain.embeddings.base import Embeddings
+from peewee import *
+
+from metrics import metrics
+
+# Pinecone rejects upsert requests over 2MB and more than 1000 vectors.
+MAX_REQUEST_BYTES = 2 * 1024 * 1024
+MAX_REQUEST_VECTORS = 1000
+
+
+class UpsertError(Exception):
+    pass
+
+
+class UpsertPipeline:
+    def __init__(
+        self,
+        index,
+        embeddings: Embeddings,
+        db: SqliteDatabase,
+        batch_size: int = 100,
+        max_concurrency: int = 4,
+        max_request_bytes: int = MAX_REQUEST_BYTES,
+        retries: int = 3,
+        backoff: float = 1.0,
+        text_key: str = "text",
+    ) -> None:
+        self.index = index
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_request_bytes = max_request_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.text_key = text_key
+
+        class UpsertedBatch(Model):
+            namespace = CharField()
+            batch_hash = CharField()
+            vector_count = IntegerField()
+            upserted_at = FloatField()
+
+            class Meta:
+                database = db
+                indexes = ((("namespace", "batch_hash"), True),)
+
+        self.db = db
+        self.model = UpsertedBatch
+        db.create_tables([UpsertedBatch], safe=True)
+
+    def batch_hash(self, ids: List[str], texts: List[str]) -> str:
+        # A batch is identified by its content, so a paper re-chunked
+        # differently is upserted again instead of being skipped.
+        digest = hashlib.sha256()
+        for vector_id, text in zip(ids, texts):
+            digest.update(vector_id.encode())
+            digest.update(b"\0")
+            digest.update(text.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def upserted_hashes(self, namespace: str) -> set:
+        return {
+            batch_hash
+            for (batch_hash,) in self.model.select(self.model.batch_hash)
+            .where(self.model.namespace == namespace)
+            .tuples()
+        }
+
+    def upsert(
+        self,
+        namespace: str,
+        texts: List[str],
+        metadatas: List[dict],
+        ids: List[str],
+        vectors: List[list] | None = None,
+    ) -> int:
+        # `vectors` can carry the embeddings of an earlier upsert of the same
+        # texts to another namespace. Entries still None are embedded here
+        # and filled in for the next caller.
+        done = self.upserted_hashes(namespace)
+        batches, skipped = [], []
+        for start in range(0, len(texts), self.batch_size):
+            end = start + self.batch_size
+            batch = (start, ids[start:end], texts[start:end], metadatas[start:end])
+            batch_hash = self.batch_hash(batch[1], batch[2])
+            (skipped if batch_hash in done else batches).append((batch_hash, *batch))
+        if skipped:
+            batches.extend(self.lost_batches(namespace, skipped))
+        metrics.cache(
+            "upsert_batches",
+            hits=-(-len(texts) // self.batch_size) - len(batches),
+            misses=len(batches),
+        )
+        if not batches:
+            return 0
+
+        # Embedding runs in the calling thread while earlier batches upsert
+        # in the pool; once max_concurrency batches are in flight embedding
+        # waits for one of them to finish.
+        upserted = 0
+        errors = []
+        in_flight: set[Future] = set()
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            for batch_hash, start, batch_ids, batch_texts, batch_metadatas in batches:
+                batch_vectors = vectors[start:start + len(batch_texts)] if vectors is not None else [None]
+                if any(vector is None for vector in batch_vectors):
+                    batch_vectors = self.embeddings.embed_documents(batch_texts)
+                    if vectors is not None:
+                        vectors[start:start + len(batch_texts)] = batch_vectors
+                while len(in_flight) >= self.max_concurrency:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    upserted += self.collect(finished, errors)
+                records = [
+                    (vector_id, vector, {**metadata, self.text_key: text})
+                    for vector_id, vector, text, metadata in zip(
+                        batch_ids, batch_vectors, batch_texts, batch_metadatas
+                    )
+                ]
+                in_flight.add(pool.submit(self.upsert_batch, namespace, batch_hash, records))
+            upserted += self.collect(wait(in_flight).done, errors)
+
+        if errors:
+            raise UpsertError(
+                f"{len(errors)} of {len(batches)} batches failed for {namespace}: {errors[0]}"
+            )
+        return upserted
+
+    def collect(self, finished: set, errors: list) -> int:
+        upserted = 0
+        for future in finished:
+            try:
+                upserted += future.result()
+            except Exception as e:
+                errors.append(e)
+        return upserted
+
+    def upsert_batch(self, namespace: str, batch_hash: str, records: list) -> int:
+        for request in self.split_requests(records):
+            self.send(namespace, request)
+        self.model.insert(
+            namespace=namespace,
+            batch_hash=batch_hash,
+            vector_count=len(records),
+            upserted_at=time.time(),
+        ).on_conflict_replace().execute()
+        return len(records)
+
+    def split_requests(self, records: list) -> Iterator[list]:
+        request, size = [], 0
+        for record in records:
+            record_size = len(json.dumps(record))
+            if request and (
+                size + record_size > self.max_request_bytes
+                or len(request) >= MAX_REQUEST_VECTORS
+            ):
+                yield request
+                request, size = [], 0
+            request.append(record)
+            size += record_size
+        if request:
+            yield request
+
+    def send(self, namespace: str, request: list) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.span("upsert"):
+                    self.index.upsert(vectors=request, namespace=namespace)
+                return
+            except Exception as e:
+                metrics.inc("upsert_retries_total")
+                if attempt == self.retries:
+                    raise UpsertError(f"Upsert of {len(request)} vectors failed: {e}") from e
+                time.sleep(self.backoff * 2**attempt)
+
+    def lost_batches(self, namespace: str, skipped: list) -> list:
+        # The table only records what was sent. Fetching the first id of each
+        # skipped batch catches a namespace deleted or an index recreated
+        # since, those batches are sent again instead of silently skipped.
+        first_ids = [batch[2][0] for batch in skipped]
+        try:
+            present = set(self.index.fetch(ids=first_ids, namespace=namespace).vectors)
+        except Exception as e:
+            print(f"Error checking {namespace} in the index. Details {e}")
+            return []
+        if not present:
+            self.forget(namespace)
+        return [batch for batch, first_id in zip(skipped, first_ids) if first_id not in present]
+
+    def forget(self, namespace: str) -> None:
+        self.model.delete().where(self.model.namespace == namespace).execute()
@@ -1,7 +1,7 @@
 import json
 import discord
-import httpx
 import jsonschema
+from downloader import downloader
 from jsonschema import validate
 from typing import Dict
 
@@ -25,10 +25,7 @@ def load_config(filename="config.json") -> dict[str, str]:
 async def download_pdf(
      link: str, filename: str
 ) -> None:
-        session = httpx.AsyncClient()   
-        response = await session.get(link)
-        with open(filename, "wb") as f:
-            f.write(response.content)
+        await downloader.download(link, filename)
 
 
 def create_pdf_embed(
@@ -36,6 +33,7 @@ def create_pdf_embed(
     link: str,
     title: str,
     description: str = "A new PDF was posted on arxiv.",
+    authors: list[str] | None = None,
 ) -> discord.Embed:
     embed = discord.Embed(
         title=title,
@@ -44,7 +42,9 @@ def create_pdf_embed(
         color=0x074B6C,
     )
     embed.add_field(name="Title", value=title, inline=True)
-    embed.add_field(name="Summary", value=summary, inline=True)
+    if authors:
+        embed.add_field(name="Authors", value=", ".join(authors)[:1024], inline=True)
+    embed.add_field(name="Summary", value=summary[:1024] or "\u200b", inline=True)
     return embed
 
 def embeded_text(string: str, title: str) -> discord.Embed:
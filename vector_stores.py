@@ -0,0 +1,533 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import uuid
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from peewee import CharField, IntegerField, Model, SqliteDatabase, TextField, chunked
+
+
+def matches_filter(metadata: dict, filter: Optional[dict]) -> bool:
+    # The subset of Pinecone's metadata filter language the bot uses.
+    for key, condition in (filter or {}).items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(key)
+        for operator, operand in condition.items():
+            if operator == "$eq" and value != operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$nin" and value in operand:
+                return False
+            if operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+    return True
+
+
+class InMemoryVectorStore(VectorStore):
+    def __init__(self, embedding: Embeddings, namespace: Optional[str] = None) -> None:
+        self.embedding = embedding
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.namespaces: dict[str, dict] = {}
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def scoped(self, namespace: str) -> "InMemoryVectorStore":
+        # Shares the data and the lock, only the default namespace differs.
+        store = copy.copy(self)
+        store.namespace = namespace
+        return store
+
+    def get_namespace(self, namespace: Optional[str]) -> dict:
+        namespace = namespace if namespace is not None else self.namespace
+        return self.namespaces.setdefault(
+            namespace or "", {"ids": [], "documents": [], "vectors": None}
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        # Precomputed `vectors` skip the embedding call.
+        vectors = kwargs.get("vectors") or self.embedding.embed_documents(texts)
+        vectors = np.array(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self.lock:
+            store = self.get_namespace(namespace)
+            positions = {row_id: i for i, row_id in enumerate(store["ids"])}
+            new_vectors = []
+            for row_id, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+                document = Document(page_content=text, metadata=dict(metadata))
+                if row_id in positions:
+                    store["documents"][positions[row_id]] = document
+                    store["vectors"][positions[row_id]] = vector
+                    continue
+                positions[row_id] = len(store["ids"])
+                store["ids"].append(row_id)
+                store["documents"].append(document)
+                new_vectors.append(vector)
+            if new_vectors:
+                blocks = [] if store["vectors"] is None else [store["vectors"]]
+                store["vectors"] = np.vstack(blocks + new_vectors)
+        return ids
+
+    def delete(
+        self, ids: Optional[List[str]] = None, namespace: Optional[str] = None, **kwargs: Any
+    ) -> Optional[bool]:
+        with self.lock:
+            store = self.get_namespace(namespace)
+            removed = set(ids or [])
+            keep = [i for i, row_id in enumerate(store["ids"]) if row_id not in removed]
+            store["ids"] = [store["ids"][i] for i in keep]
+            store["documents"] = [store["documents"][i] for i in keep]
+            store["vectors"] = store["vectors"][keep] if keep else None
+        return True
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+    ) -> List[Tuple[Document, float]]:
+        vector = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+
+        with self.lock:
+            store = self.get_namespace(namespace)
+            if store["vectors"] is None:
+                return []
+            allowed = [
+                i
+                for i, document in enumerate(store["documents"])
+                if matches_filter(document.metadata, filter)
+            ]
+            if not allowed:
+                return []
+            scores = store["vectors"][allowed] @ vector
+            top = np.argsort(-scores)[:k]
+            return [(store["documents"][allowed[i]], float(scores[i])) for i in top]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(
+                query, k=k, filter=filter, namespace=namespace
+            )
+        ]
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score(query, k=k, **kwargs)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "InMemoryVectorStore":
+        store = cls(embedding)
+        store.add_texts(texts, metadatas=metadatas, namespace=namespace)
+        return store
+
+
+class ANNIndex:
+    def __init__(
+        self,
+        directory: str,
+        min_train_size: int = 1024,
+        nprobe: int = 8,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.min_train_size = min_train_size
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+        self.vectors_file = os.path.join(directory, "vectors.bin")
+        self.centroids_file = os.path.join(directory, "centroids.npy")
+
+        db = SqliteDatabase(
+            os.path.join(directory, "rows.db"),
+            pragmas={"journal_mode": "wal", "synchronous": "normal"},
+        )
+
+        class StoredVector(Model):
+            row = IntegerField(primary_key=True)
+            doc_id = CharField(unique=True)
+            text = TextField()
+            metadata = TextField()
+            cell = IntegerField(default=-1)
+
+            class Meta:
+                database = db
+
+        self.db = db
+        self.model = StoredVector
+        db.connect(reuse_if_open=True)
+        db.create_tables([StoredVector], safe=True)
+        self.load()
+
+    def load(self) -> None:
+        self.row_ids: dict[str, int] = {}
+        self.texts: dict[int, str] = {}
+        self.metadatas: dict[int, dict] = {}
+        cells: dict[int, int] = {}
+        for row, doc_id, text, metadata, cell in self.model.select().tuples().iterator():
+            self.row_ids[doc_id] = row
+            self.texts[row] = text
+            self.metadatas[row] = json.loads(metadata)
+            cells[row] = cell
+
+        self.size = max(self.texts, default=-1) + 1
+        self.dim = None
+        self.vectors = None
+        if os.path.exists(self.vectors_file) and self.size:
+            with open(self.vectors_file, "rb") as fp:
+                self.dim = int(np.frombuffer(fp.read(4), dtype=np.int32)[0])
+            self.open_vectors(self.size)
+
+        self.alive = np.zeros(self.size, dtype=bool)
+        self.alive[list(self.texts)] = True
+        self.centroids = None
+        self.cells = np.full(self.size, -1, dtype=np.int32)
+        for row, cell in cells.items():
+            self.cells[row] = cell
+        if os.path.exists(self.centroids_file):
+            self.centroids = np.load(self.centroids_file)
+        self.trained_size = int(self.alive.sum())
+        self.build_lists()
+
+    def open_vectors(self, needed: int) -> None:
+        # The file starts with the dimension as an int32, followed by the
+        # normalised float32 rows.
+        capacity = self.vectors.shape[0] if self.vectors is not None else 0
+        if self.vectors is not None and needed <= capacity:
+            return
+        row_bytes = self.dim * 4
+        if os.path.exists(self.vectors_file):
+            capacity = (os.path.getsize(self.vectors_file) - 4) // row_bytes
+        if needed > capacity:
+            capacity = max(needed, capacity * 2, 1024)
+            if self.vectors is not None:
+                self.vectors.flush()
+            with open(self.vectors_file, "ab") as fp:
+                if fp.tell() == 0:
+                    fp.write(np.int32(self.dim).tobytes())
+                fp.truncate(4 + capacity * row_bytes)
+        self.vectors = np.memmap(
+            self.vectors_file, dtype=np.float32, mode="r+", offset=4, shape=(capacity, self.dim)
+        )
+
+    def build_lists(self) -> None:
+        # Each list keeps a contiguous in-memory copy of its rows, a query
+        # then scans a few small matrices instead of gathering rows from the
+        # memmap, which cost as much as the scoring itself.
+        self.lists = []
+        self.list_vectors = []
+        if self.centroids is None:
+            return
+        rows = np.flatnonzero(self.alive)
+        order = rows[np.argsort(self.cells[rows], kind="stable")]
+        bounds = np.searchsorted(self.cells[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        self.list_vectors = [np.asarray(self.vectors[rows]) for rows in self.lists]
+
+    def add(self, ids: List[str], vectors: np.ndarray, texts: List[str], metadatas: List[dict]) -> None:
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            self.delete([doc_id for doc_id in ids if doc_id in self.row_ids])
+
+            rows = np.arange(self.size, self.size + len(ids))
+            self.open_vectors(self.size + len(ids))
+            self.vectors[rows] = vectors
+            self.vectors.flush()
+
+            cells = np.full(len(ids), -1, dtype=np.int32)
+            if self.centroids is not None:
+                cells = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+            with self.db.atomic():
+                for batch in chunked(list(zip(rows, ids, texts, metadatas, cells)), 100):
+                    self.model.insert_many(
+                        [
+                            {
+                                "row": int(row),
+                                "doc_id": doc_id,
+                                "text": text,
+                                "metadata": json.dumps(metadata),
+                                "cell": int(cell),
+                            }
+                            for row, doc_id, text, metadata, cell in batch
+                        ]
+                    ).execute()
+
+            self.size += len(ids)
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+            self.cells = np.concatenate([self.cells, cells])
+            for row, doc_id, text, metadata in zip(rows, ids, texts, metadatas):
+                self.row_ids[doc_id] = int(row)
+                self.texts[int(row)] = text
+                self.metadatas[int(row)] = metadata
+
+            alive = int(self.alive.sum())
+            if alive >= self.min_train_size and (
+                self.centroids is None or alive >= 2 * self.trained_size
+            ):
+                self.train()
+            elif self.centroids is not None:
+                for cell in np.unique(cells):
+                    self.lists[cell] = np.concatenate([self.lists[cell], rows[cells == cell]])
+                    self.list_vectors[cell] = np.concatenate(
+                        [self.list_vectors[cell], vectors[cells == cell]]
+                    )
+
+    def delete(self, ids: List[str]) -> None:
+        with self.lock:
+            rows = [self.row_ids.pop(doc_id) for doc_id in ids if doc_id in self.row_ids]
+            if not rows:
+                return
+            with self.db.atomic():
+                for batch in chunked(rows, 500):
+                    self.model.delete().where(self.model.row.in_(batch)).execute()
+            for row in rows:
+                self.texts.pop(row, None)
+                self.metadatas.pop(row, None)
+            # Deleted rows stay in the matrix and the lists, the alive mask
+            # hides them from searches.
+            self.alive[rows] = False
+
+    def train(self, iterations: int = 10, seed: int = 0) -> None:
+        # 2 * sqrt(n) lists keep each probed list small, so nprobe lists
+        # stay well under a millisecond to scan at 50k rows.
+        rows = np.flatnonzero(self.alive)
+        nlist = int(min(4096, max(1, 2 * np.sqrt(len(rows)))))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self.vectors[rng.choice(rows, min(len(rows), nlist * 40), replace=False)])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cell in range(nlist):
+                members = sample[assignment == cell]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[cell] = centroid / max(float(np.linalg.norm(centroid)), 1e-12)
+
+        cells = np.full(self.size, -1, dtype=np.int32)
+        for start in range(0, len(rows), 8192):
+            batch = rows[start:start + 8192]
+            cells[batch] = np.argmax(np.asarray(self.vectors[batch]) @ centroids.T, axis=1)
+
+        with self.db.atomic():
+            self.db.cursor().executemany(
+                f'UPDATE "{self.model._meta.table_name}" SET cell = ? WHERE row = ?',
+                [(int(cells[row]), int(row)) for row in rows],
+            )
+        np.save(self.centroids_file, centroids)
+        self.centroids = centroids
+        self.cells = cells
+        self.trained_size = len(rows)
+        self.build_lists()
+
+    def search(self, vector: np.ndarray, k: int, filter: Optional[dict] = None) -> List[Tuple[int, float]]:
+        with self.lock:
+            if self.vectors is None or not self.alive.any():
+                return []
+            if self.centroids is not None:
+                centroid_scores = self.centroids @ vector
+                nprobe = min(self.nprobe, len(centroid_scores))
+                probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+                rows = np.concatenate([self.lists[cell] for cell in probes])
+                scores = np.concatenate([self.list_vectors[cell] @ vector for cell in probes])
+                keep = self.alive[rows]
+                if filter:
+                    keep &= np.fromiter(
+                        (matches_filter(self.metadatas.get(row, {}), filter) for row in rows),
+                        dtype=bool, count=len(rows),
+                    )
+                results = self.top(rows[keep], scores[keep], k)
+                if len(results) >= k:
+                    return results
+            # Too few hits in the probed cells, typically under a selective
+            # filter, so fall back to an exact scan.
+            return self.score(np.flatnonzero(self.alive), vector, k, filter)
+
+    def score(self, rows: np.ndarray, vector: np.ndarray, k: int, filter: Optional[dict]) -> List[Tuple[int, float]]:
+        if filter:
+            rows = np.asarray(
+                [row for row in rows if matches_filter(self.metadatas[row], filter)], dtype=np.int64
+            )
+        if not len(rows):
+            return []
+        return self.top(rows, np.asarray(self.vectors[rows]) @ vector, k)
+
+    def top(self, rows: np.ndarray, scores: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        if not len(rows):
+            return []
+        top = np.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+
+class LocalANNVectorStore(VectorStore):
+    indexes: dict[str, ANNIndex] = {}
+    indexes_lock = threading.Lock()
+
+    def __init__(self, directory: str, embedding: Embeddings, namespace: Optional[str] = None) -> None:
+        self.directory = directory
+        self.embedding = embedding
+        self.namespace = namespace
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def scoped(self, namespace: str) -> "LocalANNVectorStore":
+        return LocalANNVectorStore(self.directory, self.embedding, namespace)
+
+    def get_index(self, namespace: Optional[str]) -> ANNIndex:
+        namespace = namespace if namespace is not None else self.namespace or ""
+        path = os.path.join(
+            self.directory, hashlib.sha256(namespace.encode()).hexdigest()[:16]
+        )
+        with self.indexes_lock:
+            if path not in self.indexes:
+                self.indexes[path] = ANNIndex(path)
+            return self.indexes[path]
+
+    def normalize(self, vectors: List[List[float]]) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        # Precomputed `vectors` skip the embedding call.
+        vectors = self.normalize(kwargs.get("vectors") or self.embedding.embed_documents(texts))
+        self.get_index(namespace).add(ids, vectors, texts, metadatas)
+        return ids
+
+    def delete(
+        self, ids: Optional[List[str]] = None, namespace: Optional[str] = None, **kwargs: Any
+    ) -> Optional[bool]:
+        self.get_index(namespace).delete(ids or [])
+        return True
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+    ) -> List[Tuple[Document, float]]:
+        index = self.get_index(namespace)
+        results = index.search(self.normalize(embedding), k, filter)
+        with index.lock:
+            return [
+                (Document(page_content=index.texts[row], metadata=dict(index.metadatas[row])), score)
+                for row, score in results
+                if row in index.texts
+            ]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embedding.embed_query(query), k=k, filter=filter, namespace=namespace
+        )
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(
+                query, k=k, filter=filter, namespace=namespace
+            )
+        ]
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score(query, k=k, **kwargs)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        directory: str = "cache/vector_store",
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "LocalANNVectorStore":
+        store = cls(directory, embedding, namespace)
+        store.add_texts(texts, metadatas=metadatas, namespace=namespace)
+        return store